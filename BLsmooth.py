@@ -21,16 +21,18 @@
 # Load a MS, smooth visibilities according to the baseline lenght,
 # i.e. shorter BLs are averaged more, and write a new MS
 
-import os, sys, time
+import os, sys, time, glob
 import optparse, itertools
 import logging
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
+from scipy.signal import lfilter
+from scipy import fft
 import casacore.tables as pt
+from lib_multiproc import multiprocManager, multiprocPool, WorkerError
+from lib_ms import get_dm_mtime
 logging.basicConfig(level=logging.DEBUG)
 
-logging.info('BL-based smoother - Francesco de Gasperin')
-
 def addcol(ms, incol, outcol):
     if outcol not in ms.colnames():
         logging.info('Adding column: '+outcol)
@@ -42,147 +44,679 @@ def addcol(ms, incol, outcol):
         logging.info('Set '+outcol+'='+incol)
         pt.taql("update $ms set "+outcol+"="+incol)
 
-opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 3.0")
-opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.01]', type='float', default=0.01)
-opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 1.0]', type='float', default=1.0)
-opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
-opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
-opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
-opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
-opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
-opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
-opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
-opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
-(options, msfile) = opt.parse_args()
-
-if msfile == []:
-    opt.print_help()
-    sys.exit(0)
-msfile = msfile[0]
-
-if not os.path.exists(msfile):
-    logging.error("Cannot find MS file.")
-    sys.exit(1)
-
-# open input/output MS
-ms = pt.table(msfile, readonly=False, ack=False)
-        
-freqtab = pt.table(msfile + '/SPECTRAL_WINDOW', ack=False)
-freq = freqtab.getcol('REF_FREQUENCY')[0]
-freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
-freqtab.close()
-wav = 299792458. / freq
-timepersample = ms.getcell('INTERVAL',0)
-
-# check if ms is time-ordered
-times = ms.getcol('TIME_CENTROID')
-if not all(np.diff(times) >= 0):
-    logging.critical('This code cannot handle MS that are not time-sorted.')
-    sys.exit(1)
-
-# create column to smooth
-addcol(ms, options.incol, options.outcol)
-
-# retore WEIGHT_SPECTRUM
-if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
-    addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
-# backup WEIGHT_SPECTRUM
-elif options.weight and not options.nobackup:
-    addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
-
-# iteration on antenna1
-for ms_ant1 in ms.iter(["ANTENNA1"]):
-    ant1 = ms_ant1.getcol('ANTENNA1')[0]
-    a_ant2 = ms_ant1.getcol('ANTENNA2')
-    logging.debug('Working on antenna: %s' % ant1)
-
-    a_uvw = ms_ant1.getcol('UVW')
-    a_data = ms_ant1.getcol(options.outcol)
-    a_weights = ms_ant1.getcol('WEIGHT_SPECTRUM')
-    a_flags = ms_ant1.getcol('FLAG')
- 
-    for ant2 in sorted(set(a_ant2)):
-        if ant1 == ant2: continue # skip autocorr
-        idx = np.where(a_ant2 == ant2)
-        
-        uvw = a_uvw[idx]
-        data = a_data[idx]
-        weights = a_weights[idx]
-        flags = a_flags[idx]
-   
-        # compute the FWHM
-        uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
-        dist = np.mean(uvw_dist) / 1.e3
-        if np.isnan(dist): continue # fix for missing anstennas
-    
-        stddev_t = options.ionfactor * (25.e3 / dist)**options.bscalefactor * (freq / 60.e6) # in sec
-        stddev_t = stddev_t/timepersample # in samples
-        # TODO: for freq this is hardcoded, it should be thought better 
-        # However, the limitation is probably smearing here
-        stddev_f = 1e6/(dist) # Hz
-        stddev_f = stddev_f/freqpersample # in samples
-        logging.debug("%s - %s (dist = %.1f km) >> Time: sigma=%.1f samples (%.1f s) >> Freq: sigma=%.1f samples (%.2f MHz)" % \
-                (ant1, ant2, dist, stddev_t, timepersample*stddev_t, stddev_f, freqpersample*stddev_f/1e6))
+def gfilter_iir(x, sigma, axis):
+    """
+    Recursive gaussian filter (Young & van Vliet 1995), the cost per sample does not depend on sigma
+    The peak error of the impulse response is ~2% for sigma > 10 (4% for sigma ~ 3)
+    The 'reflect' extension used by gfilter is periodic with period 2n, so each recursion runs on one period
+    starting from its periodic steady state. The third-order recursion is split in three first-order
+    complex sections (one per pole) for which the steady state is well conditioned
+    Coefficients are computed from the poles (m0, m1, m2) as the rounded polynomials of the paper
+    are not accurate for large sigma
+    """
+    if sigma < 2.5:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    else:
+        q = 0.98711 * sigma - 0.96330
+    m0, m1, m2 = 1.16680, 1.10783, 1.40586
+    b0 = (m0 + q) * (m1**2 + m2**2 + 2*m1*q + q**2)
+    b1 = q * (2*m0*m1 + m1**2 + m2**2 + (2*m0 + 4*m1)*q + 3*q**2)
+    b2 = -q**2 * (m0 + 2*m1 + 3*q)
+    b3 = q**3
+    poles = np.roots([1, -b1/b0, -b2/b0, -b3/b0])
+    gains = [m0 * (m1**2 + m2**2) / b0 / np.prod([1 - poles[j]/poles[i] for j in range(3) if j != i]) for i in range(3)]
+
+    n = x.shape[axis]
+    period = 2*n
+    y = np.concatenate([x, np.flip(x, axis=axis)], axis=axis)
+    y = np.moveaxis(y, axis, -1).astype(np.complex128)
+    for npass in range(2): # forward and backward
+        out = 0.
+        for pole, gain in zip(poles, gains):
+            y_pole = lfilter([gain], [1, -pole], y, axis=-1)
+            # add the free response that makes the output periodic
+            out = out + y_pole + y_pole[..., -1:] / (1 - pole**period) * pole**np.arange(1, period + 1)
+        y = out[..., ::-1]
+    y = np.take(np.moveaxis(y, -1, axis), np.arange(n), axis=axis)
+    if not np.iscomplexobj(x): y = y.real
+    return y.astype(x.dtype)
+
+def gfilter_fft(x, sigma, axis, single=False):
+    """
+    Gaussian filter with the same kernel and 'reflect' boundaries of gfilter, done with FFTs
+    The reflected signal is periodic with period 2n, so one period is convolved (circularly) with the kernel
+    wrapped on the same period: the cost does not depend on sigma and the result is the same as gfilter
+    single: keep the transforms in single precision (for single precision x)
+    """
+    n = x.shape[axis]
+    radius = int(4.0 * sigma + 0.5)
+    kernel = np.exp(-0.5 / sigma**2 * np.arange(-radius, radius + 1)**2)
+    kernel /= kernel.sum()
+    kernel = np.bincount(np.arange(-radius, radius + 1) % (2*n), weights=kernel, minlength=2*n)
+
+    y = np.concatenate([x, np.flip(x, axis=axis)], axis=axis)
+    kernel_shape = [1] * x.ndim
+    if np.iscomplexobj(x):
+        kernel_shape[axis] = 2*n
+        kernel = fft.fft(kernel).real
+        if single: kernel = kernel.astype(x.real.dtype)
+        y = fft.ifft(fft.fft(y, axis=axis) * kernel.reshape(kernel_shape), axis=axis)
+    else:
+        kernel_shape[axis] = n + 1
+        kernel = fft.rfft(kernel)
+        if single: kernel = kernel.astype(np.result_type(x.dtype, np.complex64))
+        y = fft.irfft(fft.rfft(y, axis=axis) * kernel.reshape(kernel_shape), n=2*n, axis=axis)
+    return np.take(y, np.arange(n), axis=axis).astype(x.dtype)
+
+def gaussian(x, sigma, axis, options, output=None):
+    """
+    Gaussian smoothing along axis with the backend in options.backend (direct, iir or fft)
+    the direct gfilter is always used for sigma below options.backend_sigma
+    output: array (not x) where the result is written, otherwise a new array is returned
+    """
+    if options.backend == 'direct' or sigma < options.backend_sigma:
+        return gfilter(x, sigma, axis=axis, output=output)
+    elif options.backend == 'iir':
+        y = gfilter_iir(x, sigma, axis)
+    elif options.backend == 'fft':
+        y = gfilter_fft(x, sigma, axis, single=options.float32)
+    else:
+        raise ValueError('Unknown filter backend: %s' % options.backend)
+    if output is None: return y
+    output[...] = y
+    return output
+
+def baseline_sigmas(uvw, freq, timepersample, freqpersample, options):
+    """
+    Return the baseline length (km) and the smoothing sigmas in time and frequency (in samples)
+    uvw: the UVW of all the rows of a baseline
+    """
+    # compute the FWHM
+    uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
+    dist = np.mean(uvw_dist) / 1.e3
+    return (dist,) + dist_sigmas(dist, freq, timepersample, freqpersample, options)
+
+def dist_sigmas(dist, freq, timepersample, freqpersample, options):
+    """
+    Return the smoothing sigmas in time and frequency (in samples) of a baseline of length dist (km)
+    """
+    stddev_t = options.ionfactor * (25.e3 / dist)**options.bscalefactor * (freq / 60.e6) # in sec
+    stddev_t = stddev_t/timepersample # in samples
+    # TODO: for freq this is hardcoded, it should be thought better 
+    # However, the limitation is probably smearing here
+    stddev_f = 1e6/(dist) # Hz
+    stddev_f = stddev_f/freqpersample # in samples
+    return stddev_t, stddev_f
+
+def smooth_baseline(data, weights, flags, stddev_t, stddev_f, options):
+    """
+    Smooth the data and the weights of one baseline (axes: time, freq, pol)
+    or of a stack of baselines with the same sigmas (axes: baseline, time, freq, pol)
+    Return the smoothed data and weights
+    """
+    flags[ np.isnan(data) ] = True # flag NaNs
+    weights[flags] = 0 # set weight of flagged data to 0
+    del flags
     
-        if stddev_t == 0: continue # fix for flagged antennas
-        if stddev_t < 0.5: continue # avoid very small smoothing
+    # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
+    # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
+    # running weighted average with a Gaussian window function.
     
-        flags[ np.isnan(data) ] = True # flag NaNs
-        weights[flags] = 0 # set weight of flagged data to 0
-        del flags
-        
-        # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
-        # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
-        # running weighted average with a Gaussian window function.
-        
-        # set bad data to 0 so nans do not propagate
-        data = np.nan_to_num(data*weights)
-        
-        # smear weighted data and weights
-        if options.onlyamp:
-            dataAMP = np.abs(data)
-            dataPH = np.angle(data)
-            if not options.notime:
-                dataAMP = gfilter(dataAMP, stddev_t, axis=0)
-            if not options.nofreq:
-                dataAMP = gfilter(dataAMP, stddev_f, axis=1)
-        else:
-            dataR = np.real(data)
-            dataI = np.imag(data)
-            if not options.notime:
-                dataR = gfilter(dataR, stddev_t, axis=0)#, truncate=4.)
-                dataI = gfilter(dataI, stddev_t, axis=0)#, truncate=4.)
-            if not options.nofreq:
-                dataR = gfilter(dataR, stddev_f, axis=1)#, truncate=4.)
-                dataI = gfilter(dataI, stddev_f, axis=1)#, truncate=4.)
+    # set bad data to 0 so nans do not propagate
+    data = np.nan_to_num(data*weights)
     
+    # smear weighted data and weights
+    if options.onlyamp:
+        dataAMP = np.abs(data)
+        dataPH = np.angle(data)
         if not options.notime:
-            weights = gfilter(weights, stddev_t, axis=0)#, truncate=4.)
+            dataAMP = gaussian(dataAMP, stddev_t, -3, options)
         if not options.nofreq:
-            weights = gfilter(weights, stddev_f, axis=1)#, truncate=4.)
-    
+            dataAMP = gaussian(dataAMP, stddev_f, -2, options)
+    else:
+        # real and imag are smoothed together as a complex array
+        if not options.notime:
+            data = gaussian(data, stddev_t, -3, options)
+        if not options.nofreq:
+            data = gaussian(data, stddev_f, -2, options)
+
+    if not options.notime:
+        weights = gaussian(weights, stddev_t, -3, options)
+    if not options.nofreq:
+        weights = gaussian(weights, stddev_f, -2, options)
+
+    # re-create data
+    if options.onlyamp:
+        data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
+
+    data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
+
+    #print np.count_nonzero(data[~flags]), np.count_nonzero(data[flags]), 100*np.count_nonzero(data[flags])/np.count_nonzero(data)
+    #print "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags]))
+    #print "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags]))
+    #print "NANs in weights: ", np.count_nonzero(np.isnan(weights))
+    return data, weights
+
+def get_buffer(work, name, shape, dtype):
+    """
+    Return the work buffer called name, it is allocated again only if shape or dtype change
+    """
+    if name not in work or work[name].shape != tuple(shape) or work[name].dtype != dtype:
+        work[name] = np.empty(shape, dtype=dtype)
+    return work[name]
+
+def smooth_baseline_inplace(data, weights, flags, stddev_t, stddev_f, options, work):
+    """
+    Same as smooth_baseline for single precision data (complex64) and weights (float32), without temporaries:
+    data, weights and flags are overwritten, the filters write in the buffers of work (see get_buffer)
+    and the arithmetic is done with in-place ufuncs
+    Return the smoothed data and weights (either the input arrays or work buffers)
+    """
+    flags |= np.isnan(data) # flag NaNs
+    weights[flags] = 0 # set weight of flagged data to 0
+
+    # set bad data to 0 so nans do not propagate
+    np.multiply(data, weights, out=data)
+    np.nan_to_num(data, copy=False)
+
+    # the filters alternate between the array and its buffer
+    def smooth(x, buf):
+        for sigma, axis, skip in ((stddev_t, -3, options.notime), (stddev_f, -2, options.nofreq)):
+            if skip: continue
+            gaussian(x, sigma, axis, options, output=buf)
+            x, buf = buf, x
+        return x
+
+    if options.onlyamp:
+        dataPH = np.arctan2(data.imag, data.real, out=get_buffer(work, 'phase', weights.shape, weights.dtype))
+        dataAMP = np.abs(data, out=get_buffer(work, 'amp', weights.shape, weights.dtype))
+        dataAMP = smooth(dataAMP, get_buffer(work, 'amp_buf', weights.shape, weights.dtype))
         # re-create data
-        if options.onlyamp:
-            data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
-        else:
-            data = (dataR + 1j * dataI)
+        np.cos(dataPH, out=data.real)
+        np.sin(dataPH, out=data.imag)
+        data *= dataAMP
+    else:
+        data = smooth(data, get_buffer(work, 'data_buf', data.shape, data.dtype))
+    weights = smooth(weights, get_buffer(work, 'weights_buf', weights.shape, weights.dtype))
 
-        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-    
-        #print np.count_nonzero(data[~flags]), np.count_nonzero(data[flags]), 100*np.count_nonzero(data[flags])/np.count_nonzero(data)
-        #print "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags]))
-        #print "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags]))
-        #print "NANs in weights: ", np.count_nonzero(np.isnan(weights))
+    np.divide(data, weights, out=data, where=(weights != 0)) # avoid divbyzero
+    return data, weights
 
-        a_data[idx] = data
-        if options.weight: a_weights[idx] = weights
-    
-    #logging.info('Writing %s column.' % options.outcol)
-    ms_ant1.putcol(options.outcol, a_data)
+def baseline_index(ants1, ants2, times=None):
+    """
+    Group rows by baseline
+    Return the list of (ant1, ant2) and for each of them the array of its rows,
+    sorted in time if times is given (otherwise in the original order)
+    """
+    nant = int(max(np.max(ants1), np.max(ants2))) + 1
+    key = np.asarray(ants1, dtype=np.int64) * nant + ants2
+    if times is None:
+        order = np.argsort(key, kind='stable')
+    else:
+        order = np.lexsort((times, key))
+    key = key[order]
+    bounds = np.flatnonzero(np.diff(key)) + 1
+    bls = [(int(k // nant), int(k % nant)) for k in key[np.append(0, bounds)]] if len(key) > 0 else []
+    return bls, np.split(order, bounds)
+
+def get_dists(ms):
+    """
+    Compute the length (km) of all cross-correlation baselines with a single read of ANTENNA1/ANTENNA2/TIME/UVW
+    Return a dict (ant1, ant2) -> dist
+    """
+    ants1 = ms.getcol('ANTENNA1')
+    ants2 = ms.getcol('ANTENNA2')
+    times = ms.getcol('TIME')
+    uvw = ms.getcol('UVW')
+
+    # compute the FWHM
+    bls, rows = baseline_index(ants1, ants2, times)
+    uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)[np.concatenate(rows)]
+    nrows = np.array([len(bl_rows) for bl_rows in rows])
+    if np.all(nrows == nrows[0]):
+        dist = np.mean(uvw_dist.reshape(len(bls), nrows[0]), axis=1) / 1.e3 # same summation as np.mean of each baseline
+    else:
+        dist = np.add.reduceat(uvw_dist, np.cumsum(nrows) - nrows) / nrows / 1.e3
+    return dict([(bl, d) for bl, d in zip(bls, dist) if bl[0] != bl[1]]) # skip autocorr
+
+def get_dists_cached(msfile, ms, cache=True):
+    """
+    Return the baseline lengths of get_dists from the sidecar file msfile/BLsmooth_dists.npz
+    The cache is valid for the same MS path and modification time of the files that store ANTENNA1/ANTENNA2/TIME/UVW,
+    otherwise (or if cache is False) the lengths are computed and the file written again
+    """
+    cachefile = os.path.join(msfile, 'BLsmooth_dists.npz')
+    path = os.path.abspath(msfile)
+    seqnrs = set([ms.getdminfo(col)['SEQNR'] for col in ['ANTENNA1', 'ANTENNA2', 'TIME', 'UVW']])
+    mtime = get_dm_mtime(msfile, seqnrs)
+    if mtime is None and cache:
+        logging.info('Baseline lengths of %s not cached (its columns are stored in other tables).' % msfile)
+        cache = False
+
+    if cache and os.path.exists(cachefile):
+        try:
+            cached = np.load(cachefile)
+            if str(cached['path']) == path and float(cached['mtime']) == mtime:
+                logging.info('Baseline lengths read from %s.' % cachefile)
+                return dict([((int(ant1), int(ant2)), dist) for ant1, ant2, dist in zip(cached['ant1'], cached['ant2'], cached['dist'])])
+        except Exception as e:
+            logging.warning('Cannot read %s: %s' % (cachefile, e))
+
+    dists = get_dists(ms)
+    if cache:
+        bls = sorted(dists.keys())
+        try:
+            # write and rename so that a partial file is never read
+            np.savez(cachefile + '.tmp.npz', path=path, mtime=mtime, ant1=[bl[0] for bl in bls], ant2=[bl[1] for bl in bls], \
+                    dist=[dists[bl] for bl in bls])
+            os.replace(cachefile + '.tmp.npz', cachefile)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write %s: %s' % (cachefile, e))
+    return dists
+
+def get_layout(msfile):
+    """
+    Return a key of the array layout and time range of an MS: MSs with the same key
+    (e.g. the subbands of an observation) have the same baseline lengths
+    """
+    anttab = pt.table(msfile + '/ANTENNA', ack=False)
+    positions = anttab.getcol('POSITION')
+    anttab.close()
+    ms = pt.table(msfile, ack=False)
+    times = ms.getcol('TIME')
+    layout = (positions.tobytes(), ms.nrows(), np.min(times), np.max(times))
+    ms.close()
+    return layout
+
+def get_sigmas(dists, freq, timepersample, freqpersample, options):
+    """
+    Compute the smoothing sigmas of all baselines from their lengths (see get_dists)
+    If options.sigma_step is set they are quantised (see quantise_sigmas)
+    Return a dict (ant1, ant2) -> (stddev_t, stddev_f) with only the baselines to smooth
+    """
+    sigmas = {}
+    for (ant1, ant2), dist in sorted(dists.items()):
+        if np.isnan(dist): continue # fix for missing anstennas
+        stddev_t, stddev_f = dist_sigmas(dist, freq, timepersample, freqpersample, options)
+        logging.debug("%s - %s (dist = %.1f km) >> Time: sigma=%.1f samples (%.1f s) >> Freq: sigma=%.1f samples (%.2f MHz)" % \
+                (ant1, ant2, dist, stddev_t, timepersample*stddev_t, stddev_f, freqpersample*stddev_f/1e6))
+
+        if stddev_t == 0: continue # fix for flagged antennas
+        if stddev_t < 0.5: continue # avoid very small smoothing
+        sigmas[(ant1, ant2)] = (stddev_t, stddev_f)
+
+    if options.sigma_step is not None:
+        sigmas = quantise_sigmas(sigmas, options.sigma_step)
+    return sigmas
+
+def quantise_sigmas(sigmas, sigma_step):
+    """
+    Round the sigmas in logarithmic buckets of relative width sigma_step, the baselines of a bucket are then
+    smoothed together by smooth_rows
+    The sigmas are quantised once, so that the halo of the blocks (get_blocks) covers the kernels actually used
+    """
+    step = np.log(1. + sigma_step)
+    return dict([(bl, (np.exp(step * np.round(np.log(stddev_t) / step)), np.exp(step * np.round(np.log(stddev_f) / step)))) \
+            for bl, (stddev_t, stddev_f) in sigmas.items()])
+
+def get_blocks(ms, times, sigmas, options, max_memory):
+    """
+    Split the MS in blocks of whole timeslots that fit in max_memory bytes
+    times: the sorted TIME of all rows, for a non time-sorted MS the block rows refer to the time-sorted permutation
+    Each block is read with a halo of 4 sigma in time (the gaussian_filter1d truncation) so the smoothing
+    of its interior is exactly the same as if the whole MS were loaded
+    The budget includes up to one halo of smoothed rows waiting to be written (see write_pending)
+    Return a list of (startrow, endrow, interior startrow, interior endrow)
+    """
+    nslots = len(np.unique(times))
+    slot_rows = np.searchsorted(times, np.unique(times)) # first row of each timeslot
+    slot_rows = np.append(slot_rows, len(times))
+
+    # the halo must cover the largest gaussian kernel radius
+    halo = 0
+    if not options.notime and len(sigmas) > 0:
+        halo = max([int(4.0 * stddev_t + 0.5) for stddev_t, stddev_f in sigmas.values()])
+
+    # memory for DATA (complex64), WEIGHT_SPECTRUM (float32) and FLAG (bool) of a single timeslot
+    nchan, npol = ms.getcell('FLAG', 0).shape
+    slot_bytes = len(times)/float(nslots) * nchan * npol * (8 + 4 + 1)
+    nslots_block = int(max_memory / slot_bytes) - 3*halo
+    if nslots_block < 1:
+        logging.warning('Memory budget too small for a halo of %i timeslots, using blocks of 1 timeslot.' % halo)
+        nslots_block = 1
+    nslots_block = min(nslots_block, nslots)
+    logging.info('Streaming in blocks of %i timeslots (halo: %i timeslots).' % (nslots_block, halo))
+
+    blocks = []
+    for i0 in range(0, nslots, nslots_block):
+        i1 = min(i0 + nslots_block, nslots)
+        blocks.append( (slot_rows[max(i0 - halo, 0)], slot_rows[min(i1 + halo, nslots)], slot_rows[i0], slot_rows[i1]) )
+    return blocks
+
+def smooth_group_worker(key, data, weights, flags, stddev_t, stddev_f, options, outQueue=None):
+    """
+    Smooth a group of baselines sent by smooth_rows
+    """
+    if options.float32:
+        data, weights = smooth_baseline_inplace(data, weights, flags, stddev_t, stddev_f, options, {})
+    else:
+        data, weights = smooth_baseline(data, weights, flags, stddev_t, stddev_f, options)
+    if not options.weight: weights = None
+    outQueue.put([key, data, weights])
+
+def smooth_rows(b_ant1, b_ant2, b_data, b_weights, b_flags, sigmas, options, ncpu=1, b_time=None):
+    """
+    Smooth all the baselines in a set of rows, b_data and b_weights are updated in place
+    The baselines with the same sigmas (e.g. quantised with options.sigma_step, see get_sigmas) are smoothed
+    together with a single filter call per axis
+    If ncpu > 1 the groups of baselines are smoothed by a pool of processes
+    With options.float32 the groups are gathered in reused buffers and smoothed in place (see smooth_baseline_inplace)
+    b_time: TIME of the rows, needed if the rows are not time-sorted
+    """
+    groups = {} # (stddev_t, stddev_f, nrows) -> list of baseline rows
+    for bl, idx in zip(*baseline_index(b_ant1, b_ant2, b_time)):
+        if bl not in sigmas: continue
+        stddev_t, stddev_f = sigmas[bl]
+        groups.setdefault((stddev_t, stddev_f, len(idx)), []).append(idx)
+
+    if options.sigma_step is not None:
+        logging.debug('Smoothing %i baselines in %i buckets.' % (sum([len(idxs) for idxs in groups.values()]), len(groups)))
+
+    if ncpu > 1:
+        # the baselines and the smoothed results are passed through shared memory instead of being pickled
+        mpm = multiprocManager(ncpu, smooth_group_worker, shared=True)
+        for key, idxs in groups.items():
+            idx = np.array(idxs)
+            mpm.put([key, b_data[idx], b_weights[idx], b_flags[idx], key[0], key[1], options])
+        results = mpm.get()
+    elif options.float32:
+        work = {}
+        def smooth_inplace():
+            for key, idxs in groups.items():
+                idx = np.array(idxs)
+                shape = idx.shape + b_data.shape[1:]
+                data = np.take(b_data, idx, axis=0, out=get_buffer(work, 'data', shape, b_data.dtype))
+                weights = np.take(b_weights, idx, axis=0, out=get_buffer(work, 'weights', shape, b_weights.dtype))
+                flags = np.take(b_flags, idx, axis=0, out=get_buffer(work, 'flags', shape, b_flags.dtype))
+                yield [key] + list(smooth_baseline_inplace(data, weights, flags, key[0], key[1], options, work))
+        results = smooth_inplace()
+    else:
+        results = ( [key] + list(smooth_baseline(b_data[np.array(idxs)], b_weights[np.array(idxs)], b_flags[np.array(idxs)], \
+                    key[0], key[1], options)) for key, idxs in groups.items() )
+
+    for key, data, weights in results:
+        idx = np.array(groups[key]) # axes: baseline, time
+        b_data[idx] = data
+        if options.weight: b_weights[idx] = weights
+
+    if ncpu > 1: mpm.wait()
+
+def getcol(ms, col, startrow=0, nrow=-1):
+    """
+    Read an array column (of fixed shape cells) into a preallocated array
+    (getcol builds a temporary copy of the whole column, i.e. twice the memory)
+    """
+    if nrow < 0: nrow = ms.nrows() - startrow
+    cell = ms.getcell(col, startrow)
+    if not isinstance(cell, np.ndarray):
+        return ms.getcol(col, startrow=startrow, nrow=nrow) # scalar column
+    col_data = np.empty((nrow,) + cell.shape, dtype=cell.dtype)
+    ms.getcolnp(col, col_data, startrow=startrow, nrow=nrow)
+    return col_data
+
+def smooth_block(ms, block, sigmas, options, ncpu=1, rows=None):
+    """
+    Read a block of rows (with halo), smooth all its baselines and return the data and weights of the interior rows
+    The block is read with one getcol per column on a contiguous row range, i.e. sequentially in storage order,
+    the baselines are then gathered in memory (see baseline_index)
+    rows: for a non time-sorted MS, the MS rows of the block in time order (the block is then a range of this list)
+    they are read in storage order and permuted in memory
+    """
+    r0, r1, ri0, ri1 = block
+    cols = ['ANTENNA1', 'ANTENNA2', 'TIME', options.outcol, 'WEIGHT_SPECTRUM', 'FLAG']
+    if rows is None:
+        b_ant1, b_ant2, b_time, b_data, b_weights, b_flags = [getcol(ms, col, startrow=r0, nrow=r1-r0) for col in cols]
+    else:
+        order = np.argsort(rows)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        ms_block = ms.selectrows(rows[order])
+        b_ant1, b_ant2, b_time, b_data, b_weights, b_flags = [getcol(ms_block, col)[inverse] for col in cols]
+        ms_block.close()
+
+    smooth_rows(b_ant1, b_ant2, b_data, b_weights, b_flags, sigmas, options, ncpu, b_time)
+
+    # keep only the interior
+    b_data = b_data[ri0-r0:ri1-r0]
+    if options.weight: b_weights = b_weights[ri0-r0:ri1-r0]
+    else: b_weights = None
+    return b_data, b_weights
+
+def write_pending(ms, pending, upto, options, perm=None):
+    """
+    Write the smoothed rows in pending that are before row upto, the others are kept in pending
+    Rows cannot be written as long as a block that still has to be read includes them in its halo
+    pending: list of [startrow, data, weights]
+    perm: time-sorted permutation of the rows for a non time-sorted MS (rows in pending refer to it)
+    """
+    keep = []
+    for startrow, data, weights in pending:
+        nrow = min(len(data), upto - startrow)
+        if nrow > 0 and perm is None:
+            ms.putcol(options.outcol, data[:nrow], startrow=startrow, nrow=nrow)
+            if options.weight:
+                ms.putcol('WEIGHT_SPECTRUM', weights[:nrow], startrow=startrow, nrow=nrow)
+        elif nrow > 0:
+            # write in storage order
+            rows = perm[startrow:startrow+nrow]
+            order = np.argsort(rows)
+            ms_block = ms.selectrows(rows[order])
+            ms_block.putcol(options.outcol, data[:nrow][order])
+            if options.weight:
+                ms_block.putcol('WEIGHT_SPECTRUM', weights[:nrow][order])
+            ms_block.close()
+        nrow = max(nrow, 0)
+        if nrow < len(data):
+            # copy, a view would keep the whole block (with its halo) in memory
+            if options.weight: weights = weights[nrow:].copy()
+            keep.append([startrow + nrow, data[nrow:].copy(), weights])
+    pending[:] = keep
+
+def smooth_block_worker(msfile, block, sigmas, options, rows=None, outQueue=None):
+    """
+    Read (read-only) and smooth one block, the writing is left to the parent process
+    """
+    ms = pt.table(msfile, ack=False)
+    logging.debug('Working on rows: %i - %i' % (block[2], block[3]))
+    b_data, b_weights = smooth_block(ms, block, sigmas, options, rows=rows)
+    ms.close()
+    outQueue.put([block, b_data, b_weights])
+
+def get_ms_memory(ms):
+    """
+    Return the bytes of DATA (complex64), WEIGHT_SPECTRUM (float32) and FLAG (bool) of the whole MS
+    """
+    nchan, npol = ms.getcell('FLAG', 0).shape
+    return ms.nrows() * nchan * npol * (8 + 4 + 1)
+
+def smooth_ms(msfile, options, dists=None, max_memory=None):
+    """
+    Smooth one MS
+    dists: baseline lengths (see get_dists), computed from the MS if not given
+    max_memory: memory budget in bytes (None: load the whole MS)
+    """
+    # open input/output MS
+    ms = pt.table(msfile, readonly=False, ack=False)
+            
+    freqtab = pt.table(msfile + '/SPECTRAL_WINDOW', ack=False)
+    freq = freqtab.getcol('REF_FREQUENCY')[0]
+    freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
+    freqtab.close()
+    timepersample = ms.getcell('INTERVAL',0)
+
+    # check if ms is time-ordered, otherwise the time blocks are taken on a time-sorted permutation of the rows
+    times = ms.getcol('TIME')
+    perm = None
+    if not all(np.diff(times) >= 0):
+        logging.info('MS is not time-sorted, smoothing through a time-sorted index.')
+        perm = np.argsort(times, kind='stable')
+        times = times[perm]
+
+    # create column to smooth
+    addcol(ms, options.incol, options.outcol)
+
+    # retore WEIGHT_SPECTRUM
+    if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
+        addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
+    # backup WEIGHT_SPECTRUM
+    elif options.weight and not options.nobackup:
+        addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
+
+    if dists is None: dists = get_dists_cached(msfile, ms, not options.nocache)
+    sigmas = get_sigmas(dists, freq, timepersample, freqpersample, options)
+
+    # read and write the MS in time blocks of contiguous rows (the whole MS if no memory limit)
+    # with more blocks each worker (if any) holds a block and this process one result
+    if max_memory is None:
+        blocks = [(0, ms.nrows(), 0, ms.nrows())]
+    else:
+        blocks = get_blocks(ms, times, sigmas, options, max_memory / (options.ncpu + 1 if options.ncpu > 1 else 1))
+    if len(blocks) == 1: perm = None # a single block needs no permutation, baselines are time-sorted in memory
+
+    pending = []
+    todo = [block[0] for block in blocks] # first row read by each block not yet smoothed
+    if options.ncpu > 1 and len(blocks) > 1:
+        # the workers are forked with the MS closed, otherwise they share its open files (and locks) with this process
+        ms.close()
+        mpm = multiprocManager(options.ncpu, smooth_block_worker, shared=True) # smoothed blocks through shared memory
+        ms = pt.table(msfile, readonly=False, ack=False)
+        ms.unlock()
+        def smooth_parallel():
+            # the next block is sent only after a result has been written and while the blocks in the workers plus the
+            # results waiting in pending are at most ncpu+1, even if the results arrive out of order (see get_blocks)
+            nsent = 0
+            while todo:
+                nrunning = nsent - (len(blocks) - len(todo))
+                while nsent < len(blocks) and (nrunning == 0 or nrunning + len(pending) <= options.ncpu):
+                    block = blocks[nsent]
+                    mpm.put([msfile, block, sigmas, options, None if perm is None else perm[block[0]:block[1]]])
+                    nsent += 1
+                    nrunning += 1
+                yield next(mpm.get())
+        results = smooth_parallel()
+    else:
+        # with a single block the workers (if any) smooth groups of baselines
+        results = ( [block] + list(smooth_block(ms, block, sigmas, options, options.ncpu, None if perm is None else perm[block[0]:block[1]])) \
+                    for block in blocks )
+
+    for block, b_data, b_weights in results:
+        todo.remove(block[0])
+        pending.append([block[2], b_data, b_weights])
+        write_pending(ms, pending, min(todo) if todo else ms.nrows(), options, perm)
+        del b_data, b_weights # release the block before reading the next one
+        if options.ncpu > 1 and len(blocks) > 1:
+            ms.flush()
+            ms.unlock()
+
+    if options.ncpu > 1 and len(blocks) > 1: mpm.wait()
+
+    ms.close()
+
+def smooth_ms_worker(msfile, options, dists, max_memory, outQueue=None):
+    """
+    Smooth one MS of a batch in a worker process, an error is raised in the parent process (WorkerError)
+    """
+    logging.info('Working on MS: %s' % msfile)
+    smooth_ms(msfile, options, dists, max_memory)
+    outQueue.put(msfile)
+
+if __name__ == '__main__':
+    logging.info('BL-based smoother - Francesco de Gasperin')
+
+    opt = optparse.OptionParser(usage="%prog [options] MS [MS ...] (or quoted globs, e.g. 'L*_SB*.MS')", version="%prog 3.0")
+    opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.01]', type='float', default=0.01)
+    opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 1.0]', type='float', default=1.0)
+    opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
+    opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
+    opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
+    opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
+    opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
+    opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
+    opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
+    opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
+    opt.add_option('-n', '--ncpu', help='Number of processes used to smooth baselines (or time blocks with -m) in parallel, the MS is written by the main process only [default: 1]', type='int', default=1)
+    opt.add_option('-k', '--sigma-step', help='Quantise the sigmas in buckets of this relative width (e.g. 0.05) and smooth all baselines of a bucket together, faster but approximated [default: exact sigmas]', type='float', default=None, dest='sigma_step')
+    opt.add_option('-g', '--backend', help='Filter used for large sigmas: direct (gaussian_filter1d), fft (same result, cost independent of sigma) or iir (recursive, cost independent of sigma, approximated to ~2%%) [default: direct]', type='choice', choices=['direct', 'iir', 'fft'], default='direct')
+    opt.add_option('-G', '--backend-sigma', help='Sigma (in samples) above which the --backend filter is used instead of the direct one [default: 10]', type='float', default=10., dest='backend_sigma')
+    opt.add_option('-p', '--float32', help='Smooth in single precision with preallocated buffers and in-place operations, less memory and faster [default: False]', action="store_true", default=False)
+    opt.add_option('-m', '--max-memory', help='Stream the MS in time blocks so that the visibilities in memory do not exceed this many GB [default: load the whole MS]', type='float', default=None, dest='max_memory')
+    opt.add_option('-c', '--nocache', help='Do not use the baseline lengths cached in MS/BLsmooth_dists.npz by previous runs [default: use it]', action="store_true", default=False)
+    opt.add_option('-j', '--nms', help='Number of MSs smoothed concurrently (each with its own -n processes), i.e. MSs open at the same time, the biggest first and only while their size fits in -m (or 80% of the available memory) [default: 1]', type='int', default=1)
+    (options, msfiles) = opt.parse_args()
+
+    if msfiles == []:
+        opt.print_help()
+        sys.exit(0)
+    msfiles = sorted(set(itertools.chain(*[glob.glob(msfile) or [msfile] for msfile in msfiles])))
+
+    for msfile in msfiles:
+        if not os.path.exists(msfile):
+            logging.error("Cannot find MS file: %s." % msfile)
+            sys.exit(1)
+
+    max_memory = None
+    if options.max_memory is not None:
+        max_memory = options.max_memory * 1024**3 / min(options.nms, len(msfiles))
+
+    if len(msfiles) == 1:
+        smooth_ms(msfiles[0], options, max_memory=max_memory)
+        logging.info("Done.")
+        sys.exit(0)
+
+    # MSs with the same layout (e.g. subbands of an observation) share the baseline lengths
+    logging.info('Smoothing %i MSs.' % len(msfiles))
+    layout_dists = {}
+    jobs = [] # [msfile, dists, memory]
+    errors = []
+    for msfile in msfiles:
+        # an MS that cannot be read is reported with the failed ones, the others go on
+        try:
+            layout = get_layout(msfile)
+            with pt.table(msfile, ack=False) as ms:
+                if layout not in layout_dists:
+                    layout_dists[layout] = get_dists_cached(msfile, ms, not options.nocache)
+                jobs.append([msfile, layout_dists[layout], get_ms_memory(ms)])
+        except Exception:
+            logging.exception('Error reading %s' % msfile)
+            errors.append(msfile)
+    logging.info('Baseline lengths computed for %i array layout(s).' % len(layout_dists))
 
-    if options.weight:
-        #logging.warning('Writing WEIGHT_SPECTRUM column.')
-        ms_ant1.putcol('WEIGHT_SPECTRUM', a_weights)
+    if options.nms > 1:
+        # the biggest MSs are started first, as long as the loaded MSs fit in memory (-m or the available memory)
+        with multiprocPool(options.nms, max_memory=None if options.max_memory is None else options.max_memory * 1024**3) as pool:
+            for msfile, dists, memory in jobs:
+                pool.submit(smooth_ms_worker, [msfile, options, dists, max_memory], \
+                        memory=memory if max_memory is None else min(memory, max_memory))
+            # a failed MS raises WorkerError (with the traceback of the worker), the other MSs go on
+            done = []
+            while True:
+                try:
+                    for msfile in pool.get():
+                        done.append(msfile)
+                    break
+                except WorkerError as e:
+                    logging.error(e)
+        errors += [msfile for msfile, dists, memory in jobs if msfile not in done]
+    else:
+        for msfile, dists, memory in jobs:
+            logging.info('Working on MS: %s' % msfile)
+            try:
+                smooth_ms(msfile, options, dists, max_memory)
+            except Exception:
+                logging.exception('Error smoothing %s' % msfile)
+                errors.append(msfile)
 
-ms.close()
-logging.info("Done.")
+    if errors:
+        logging.error('Failed MSs: %s' % ', '.join(errors))
+        sys.exit(1)
+    logging.info("Done.")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: bench_blsmooth.py [--nant 64] [--ntime 60] [--nchan 16]
+# Benchmark the BLsmooth.py smoothing engines (sigma buckets, filter backends and float32 mode)
+# on a synthetic MS held in memory (64 antennas -> 2016 cross-correlations), no disk I/O is involved
+# Accuracy is reported as the maximum difference relative to the exact per-baseline direct filter
+# Peak memory is the high-water mark of the resident memory during the smoothing, above the memory in use
+# before it (the high-water mark is reset for each run, see lib_timer, Linux only)
+
+import time, argparse, logging, optparse
+import numpy as np
+
+import BLsmooth
+import lib_timer
+
+def make_rows(nant, ntime, nchan, npol=4, seed=0):
+    """
+    Create the rows of a synthetic time-sorted MS with autocorrelations
+    Antennas are spread log-uniformly between 100 m and 100 km from the centre
+    Return ant1, ant2, uvw, data, weights, flags
+    """
+    rng = np.random.default_rng(seed)
+    radius = 10**rng.uniform(2, 5, nant)
+    angle = rng.uniform(0, 2*np.pi, nant)
+    pos = np.column_stack([radius*np.cos(angle), radius*np.sin(angle), np.zeros(nant)])
+
+    a1, a2 = np.triu_indices(nant)
+    ant1 = np.tile(a1, ntime)
+    ant2 = np.tile(a2, ntime)
+    uvw = pos[ant2] - pos[ant1]
+    shape = (len(ant1), nchan, npol)
+    data = (rng.normal(size=shape) + 1j*rng.normal(size=shape)).astype(np.complex64)
+    weights = rng.uniform(0.5, 1.5, shape).astype(np.float32)
+    flags = rng.uniform(size=shape) < 0.05
+    return ant1, ant2, uvw, data, weights, flags
+
+def get_options(sigma_step, ionfactor=0.01, backend='direct', backend_sigma=10., float32=False):
+    return optparse.Values({'ionfactor': ionfactor, 'bscalefactor': 1.0, 'weight': True, 'onlyamp': False, \
+            'notime': False, 'nofreq': False, 'sigma_step': sigma_step, 'backend': backend, 'backend_sigma': backend_sigma, \
+            'float32': float32})
+
+def run(rows, sigmas, options):
+    ant1, ant2, uvw, data, weights, flags = rows
+    if options.sigma_step is not None:
+        sigmas = BLsmooth.quantise_sigmas(sigmas, options.sigma_step)
+    data = data.copy()
+    weights = weights.copy()
+    flags = flags.copy()
+    usage = lib_timer.get_resources()
+    reset = lib_timer.reset_peak(usage[1])
+    start = time.time()
+    BLsmooth.smooth_rows(ant1, ant2, data, weights, flags, sigmas, options)
+    wall = time.time() - start
+    peak = (lib_timer.get_resources()[1] - usage[0]) / 1024.**2 if reset else float('nan')
+    return wall, peak, data, weights
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of BLsmooth.py sigma buckets and filter backends')
+    parser.add_argument('--nant', type=int, default=64, help='Number of antennas (default: 64)')
+    parser.add_argument('--ntime', type=int, default=60, help='Number of timeslots (default: 60)')
+    parser.add_argument('--nchan', type=int, default=16, help='Number of channels (default: 16)')
+    parser.add_argument('--ionfactor', type=float, default=0.01, help='BLsmooth.py ionfactor, sets the size of the kernels (default: 0.01)')
+    parser.add_argument('--steps', type=float, nargs='+', default=[0.01, 0.05, 0.1], help='Bucket widths to test (default: 0.01 0.05 0.1)')
+    parser.add_argument('--backends', nargs='+', default=['iir', 'fft'], help='Filter backends to test (default: iir fft)')
+    parser.add_argument('--backend-sigma', type=float, default=10., dest='backend_sigma', help='Sigma above which the backend is used (default: 10)')
+    args = parser.parse_args()
+    logging.root.setLevel(logging.INFO)
+
+    rows = make_rows(args.nant, args.ntime, args.nchan)
+    freq, timepersample, freqpersample = 150e6, 4., 48828.125
+    sigmas = {}
+    for bl, idx in zip(*BLsmooth.baseline_index(rows[0], rows[1])):
+        if bl[0] == bl[1]: continue
+        dist, stddev_t, stddev_f = BLsmooth.baseline_sigmas(rows[2][idx], freq, timepersample, freqpersample, get_options(None, args.ionfactor))
+        if stddev_t >= 0.5: sigmas[bl] = (stddev_t, stddev_f)
+    print('Synthetic MS: %i rows, %i baselines smoothed, %i timeslots, %i channels' % \
+            (len(rows[0]), len(sigmas), args.ntime, args.nchan))
+    print('Sigmas: time %.1f-%.1f samples, freq %.1f-%.1f samples' % \
+            (min([s[0] for s in sigmas.values()]), max([s[0] for s in sigmas.values()]), \
+             min([s[1] for s in sigmas.values()]), max([s[1] for s in sigmas.values()])))
+
+    t_ref, peak_ref, data_ref, weights_ref = run(rows, sigmas, get_options(None, args.ionfactor))
+    print('%-12s %8.2f s  peak: %7.1f MB' % ('per-baseline', t_ref, peak_ref))
+    for step in args.steps:
+        t, peak, data, weights = run(rows, sigmas, get_options(step, args.ionfactor))
+        err = np.nanmax(np.abs(data - data_ref)) / np.nanmax(np.abs(data_ref))
+        print('%-12s %8.2f s  speedup: %5.1fx  peak: %7.1f MB  max rel. difference: %.2e' % ('step=%g' % step, t, t_ref/t, peak, err))
+    for backend in args.backends:
+        t, peak, data, weights = run(rows, sigmas, get_options(None, args.ionfactor, backend, args.backend_sigma))
+        err = np.nanmax(np.abs(data - data_ref)) / np.nanmax(np.abs(data_ref))
+        print('%-12s %8.2f s  speedup: %5.1fx  peak: %7.1f MB  max rel. difference: %.2e' % (backend, t, t_ref/t, peak, err))
+    t, peak, data, weights = run(rows, sigmas, get_options(None, args.ionfactor, float32=True))
+    err = np.nanmax(np.abs(data - data_ref)) / np.nanmax(np.abs(data_ref))
+    print('%-12s %8.2f s  speedup: %5.1fx  peak: %7.1f MB  max rel. difference: %.2e' % ('float32', t, t_ref/t, peak, err))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: bench_ms.py [--nant 24] [--ntime 200] [--nchan 32] [--scripts BLsmooth reweight ...] [--history bench_ms_history.json]
+# Benchmark of the MS processing scripts on a synthetic MS built with casacore (no real data needed)
+# Each script runs on a fresh copy of the MS in a child process that records wall time, cpu time (user+sys),
+# peak RSS and bytes read/written (/proc/self/io, worker processes included once they are joined)
+# Results are appended to a JSON history and compared with the previous run of the same benchmark
+# Note: rchar/wchar count all the read/written bytes, read_bytes/write_bytes only those that reached the disk
+# (an MS just written is usually read from the page cache)
+
+import os, sys, time, json, shutil, argparse, logging, tempfile, subprocess, platform
+import numpy as np
+
+# name -> command line, {ms} and {h5} are replaced with the MS and H5parm names
+SCRIPTS = {
+    'BLsmooth': ['BLsmooth.py', '-w', '{ms}'],
+    'reweight': ['reweight.py', '-m', 'subchan', '{ms}'],
+    'mslin2circ': ['mslin2circ.py', '-i', '{ms}:DATA', '-o', '{ms}:CORRECTED_DATA'],
+    'flagonmindata': ['flagonmindata.py', '{ms}'],
+    'applycal': ['applycal.py', '-i', '{ms}', '--inh5', '{h5}', '-d', 'dir1'],
+}
+
+def make_ms(msfile, nant, ntime, nchan, interval=4., seed=0):
+    """
+    Create a synthetic LOFAR-like MS (4 linear pols, with autocorrelations, time-sorted)
+    DATA contains a point source plus noise, FLAG has random flags (~3%), two RFI channels,
+    a dead antenna and a fully flagged timeslot
+    """
+    import casacore.tables as pt
+    rng = np.random.default_rng(seed)
+    npol = 4
+
+    ms = pt.default_ms(msfile)
+    for col, value, valuetype in (('DATA', 0j, 'complex'), ('WEIGHT_SPECTRUM', 0., 'float')):
+        ms.addcols(pt.maketabdesc([pt.makearrcoldesc(col, value, ndim=2, shape=[nchan, npol], valuetype=valuetype)]), \
+                {'TYPE': 'TiledColumnStMan', 'NAME': 'Tiled'+col, 'SPEC': {'DEFAULTTILESHAPE': [npol, nchan, 128]}})
+
+    # stations spread log-uniformly between 100 m and 50 km from the centre
+    radius = 10**rng.uniform(2, np.log10(5e4), nant)
+    angle = rng.uniform(0, 2*np.pi, nant)
+    pos = np.column_stack([radius*np.cos(angle), radius*np.sin(angle), rng.normal(0, 10, nant)])
+
+    ants1, ants2 = np.triu_indices(nant)
+    nbl = len(ants1)
+    times = 4.87e9 + interval * np.arange(ntime)
+    hourangle = np.repeat(2*np.pi * interval * np.arange(ntime) / 86164., nbl)
+    a1 = np.tile(ants1, ntime)
+    a2 = np.tile(ants2, ntime)
+    bl = pos[a2] - pos[a1]
+    uvw = np.column_stack([bl[:,0]*np.cos(hourangle) - bl[:,1]*np.sin(hourangle), \
+                           bl[:,0]*np.sin(hourangle) + bl[:,1]*np.cos(hourangle), bl[:,2]])
+    freqs = 120e6 + 48828.125 * np.arange(nchan)
+    nrow = nbl * ntime
+
+    # 1 Jy source at l=0.01 in XX/YY, noise in all pols
+    data = 0.5 * (rng.normal(size=(nrow, nchan, npol)) + 1j*rng.normal(size=(nrow, nchan, npol)))
+    data[:, :, [0, 3]] += np.exp(2j*np.pi * 0.01 * uvw[:, 0:1] * freqs / 299792458.)[:, :, np.newaxis]
+    flags = rng.uniform(size=(nrow, nchan, npol)) < 0.03
+    flags[:, rng.choice(nchan, min(2, nchan), replace=False), :] = True # RFI channels
+    flags[(a1 == nant-1) | (a2 == nant-1)] = True # dead antenna
+    flags[ntime//2*nbl:(ntime//2+1)*nbl] = True # lost timeslot
+
+    ms.addrows(nrow)
+    ms.putcol('TIME', np.repeat(times, nbl))
+    ms.putcol('TIME_CENTROID', np.repeat(times, nbl))
+    ms.putcol('INTERVAL', np.full(nrow, interval))
+    ms.putcol('EXPOSURE', np.full(nrow, interval))
+    ms.putcol('ANTENNA1', a1)
+    ms.putcol('ANTENNA2', a2)
+    ms.putcol('UVW', uvw)
+    ms.putcol('DATA', data.astype(np.complex64))
+    ms.putcol('FLAG', flags)
+    ms.putcol('WEIGHT_SPECTRUM', np.ones((nrow, nchan, npol), dtype=np.float32))
+    ms.close()
+
+    anttab = pt.table(msfile+'/ANTENNA', readonly=False, ack=False)
+    anttab.addrows(nant)
+    anttab.putcol('NAME', ['ST%03i' % i for i in range(nant)])
+    anttab.putcol('POSITION', pos + [3826577., 461022., 5064892.])
+    anttab.close()
+    feedtab = pt.table(msfile+'/FEED', readonly=False, ack=False)
+    feedtab.addrows(nant)
+    feedtab.putcol('ANTENNA_ID', np.arange(nant))
+    feedtab.putcol('NUM_RECEPTORS', np.full(nant, 2))
+    for i in range(nant):
+        feedtab.putcell('POLARIZATION_TYPE', i, np.array(['X', 'Y']))
+    feedtab.close()
+    poltab = pt.table(msfile+'/POLARIZATION', readonly=False, ack=False)
+    poltab.addrows(1)
+    poltab.putcell('NUM_CORR', 0, npol)
+    poltab.putcell('CORR_TYPE', 0, np.array([9, 10, 11, 12]))
+    poltab.close()
+    spwtab = pt.table(msfile+'/SPECTRAL_WINDOW', readonly=False, ack=False)
+    spwtab.addrows(1)
+    spwtab.putcell('NUM_CHAN', 0, nchan)
+    spwtab.putcell('CHAN_FREQ', 0, freqs)
+    spwtab.putcell('REF_FREQUENCY', 0, np.mean(freqs))
+    spwtab.putcell('CHAN_WIDTH', 0, np.full(nchan, 48828.125))
+    spwtab.putcell('RESOLUTION', 0, np.full(nchan, 48828.125))
+    spwtab.putcell('EFFECTIVE_BW', 0, np.full(nchan, 48828.125))
+    spwtab.putcell('TOTAL_BANDWIDTH', 0, 48828.125 * nchan)
+    spwtab.close()
+    return nrow
+
+def make_h5parm(h5file, msfile, ndir=2, seed=0):
+    """
+    Create an H5parm with tec and scalarphase solutions for all antennas/directions/times of msfile (as used by applycal.py)
+    """
+    import tables
+    import casacore.tables as pt
+    rng = np.random.default_rng(seed)
+    ms = pt.table(msfile, ack=False)
+    times = np.unique(ms.getcol('TIME'))
+    ms.close()
+    anttab = pt.table(msfile+'/ANTENNA', ack=False)
+    nant = anttab.nrows()
+    anttab.close()
+
+    h5 = tables.open_file(h5file, 'w')
+    solset = h5.create_group('/', 'sol000')
+    dirnames = ['dir%i' % i for i in range(ndir)]
+    source = h5.create_table(solset, 'source', np.dtype([('name', 'S128'), ('dir', np.float32, (2,))]))
+    source.append([(name, [0., 0.]) for name in dirnames])
+    for soltab_name, scale in (('tec000', 0.01), ('scalarphase000', 0.1)):
+        soltab = h5.create_group(solset, soltab_name)
+        h5.create_array(soltab, 'val', rng.normal(0, scale, (nant, ndir, len(times))))
+        h5.create_array(soltab, 'weight', np.ones((nant, ndir, len(times))))
+        h5.create_array(soltab, 'time', times)
+        h5.create_array(soltab, 'dir', np.array(dirnames, dtype='S'))
+    h5.close()
+
+def run_child(outfile, argv):
+    """
+    Run a script (argv[0]) as __main__ in this process and write the resources used to outfile (JSON)
+    """
+    import runpy, resource, multiprocessing
+    sys.argv = argv
+    sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+    status = 'ok'
+    start = time.time()
+    try:
+        runpy.run_path(argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0): status = 'exit code %s' % e.code
+    except BaseException as e:
+        status = '%s: %s' % (type(e).__name__, (str(e).strip().splitlines() or [''])[0])
+    # join the worker processes so that their resources are accounted to this process
+    for p in multiprocessing.active_children():
+        p.join()
+    wall = time.time() - start
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss of this process is inherited from the parent through fork/exec, VmHWM is not
+    maxrss = usage_self.ru_maxrss
+    if os.path.exists('/proc/self/status'):
+        maxrss = [int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmHWM')][0]
+    # with $TIMER_RESOURCES the timers of the script reset VmHWM, they keep the peak before the resets
+    if 'lib_timer' in sys.modules:
+        maxrss = max(maxrss, sys.modules['lib_timer'].get_peak() // 1024)
+    result = {'status': status, 'wall_s': wall, \
+              'cpu_s': usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime, \
+              'maxrss_mb': max(maxrss, usage_children.ru_maxrss) / 1024.}
+    if os.path.exists('/proc/self/io'):
+        for line in open('/proc/self/io'):
+            key, value = line.split(':')
+            if key in ['rchar', 'wchar', 'read_bytes', 'write_bytes']: result[key] = int(value)
+    with open(outfile, 'w') as f:
+        json.dump(result, f)
+
+def run_script(name, msfile, h5file, workdir):
+    """
+    Run the benchmark of one script on a fresh copy of msfile
+    Return the dict of measured resources
+    """
+    ms_copy = os.path.join(workdir, 'bench.MS')
+    shutil.rmtree(ms_copy, ignore_errors=True)
+    shutil.copytree(msfile, ms_copy)
+    argv = [arg.format(ms=ms_copy, h5=h5file) for arg in SCRIPTS[name]]
+    argv[0] = os.path.join(os.path.dirname(os.path.abspath(__file__)), argv[0])
+    outfile = os.path.join(workdir, 'result.json')
+    if os.path.exists(outfile): os.remove(outfile)
+
+    with open(os.path.join(workdir, name+'.log'), 'w') as log:
+        subprocess.call([sys.executable, os.path.abspath(__file__), '--child', outfile] + argv, \
+                cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    if os.path.exists(outfile):
+        with open(outfile) as f:
+            result = json.load(f)
+    else:
+        result = {'status': 'crashed'}
+    shutil.rmtree(ms_copy, ignore_errors=True)
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, \
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmark of the MS processing scripts on a synthetic MS')
+    parser.add_argument('--nant', type=int, default=24, help='Number of antennas (default: 24)')
+    parser.add_argument('--ntime', type=int, default=200, help='Number of timeslots (default: 200)')
+    parser.add_argument('--nchan', type=int, default=32, help='Number of channels (default: 32)')
+    parser.add_argument('--scripts', nargs='+', default=sorted(SCRIPTS.keys()), choices=sorted(SCRIPTS.keys()), \
+            help='Scripts to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of each script, the fastest is kept (default: 1)')
+    parser.add_argument('--history', default='bench_ms_history.json', help='JSON file where results are appended (default: bench_ms_history.json)')
+    parser.add_argument('--workdir', default=None, help='Directory for the synthetic MS (default: a temporary directory)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    workdir = tempfile.mkdtemp(prefix='bench_ms_', dir=args.workdir)
+    msfile = os.path.join(workdir, 'synthetic.MS')
+    h5file = os.path.join(workdir, 'synthetic.h5')
+    logging.info('Creating synthetic MS: %i antennas, %i timeslots, %i channels' % (args.nant, args.ntime, args.nchan))
+    nrow = make_ms(msfile, args.nant, args.ntime, args.nchan)
+    ms_bytes = sum([os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(msfile) for f in files])
+    if 'applycal' in args.scripts:
+        try:
+            make_h5parm(h5file, msfile)
+        except ImportError as e:
+            logging.warning('Cannot create the H5parm for applycal (%s).' % e)
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    import casacore
+    setup = {'nant': args.nant, 'ntime': args.ntime, 'nchan': args.nchan, 'npol': 4, 'nrow': nrow, 'ms_bytes': ms_bytes}
+    info = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'host': platform.node(), \
+            'python': platform.python_version(), 'numpy': np.__version__, 'casacore': getattr(casacore, '__version__', None)}
+
+    print('%-14s %-30s %9s %9s %9s %10s %10s %8s' % ('script', 'status', 'wall [s]', 'cpu [s]', 'RSS [MB]', 'read [MB]', 'write [MB]', 'vs last'))
+    for name in args.scripts:
+        results = [run_script(name, msfile, h5file, workdir) for i in range(args.repeat)]
+        result = min(results, key=lambda r: r.get('wall_s', np.inf))
+        record = dict(info, script=name, args=SCRIPTS[name], **setup)
+        record.update(result)
+
+        # compare with the last successful run of the same benchmark
+        previous = [r for r in history if r['script'] == name and r['args'] == record['args'] and r['status'] == 'ok' \
+                    and all([r.get(k) == v for k, v in setup.items()])]
+        ratio = ''
+        if previous and result['status'] == 'ok':
+            ratio = '%.2fx' % (result['wall_s'] / previous[-1]['wall_s'])
+        history.append(record)
+        print('%-14s %-30s %9.2f %9.2f %9.0f %10.1f %10.1f %8s' % (name, result['status'][:30], result.get('wall_s', np.nan), \
+                result.get('cpu_s', np.nan), result.get('maxrss_mb', np.nan), result.get('rchar', np.nan)/1024.**2, \
+                result.get('wchar', np.nan)/1024.**2, ratio))
+
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=1)
+    logging.info('Results appended to %s (logs in %s).' % (args.history, workdir))
+    shutil.rmtree(msfile, ignore_errors=True)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: bench_multiproc.py [--sizes 1 16 128] [--ntasks 8] [--ncpu 2] [--nsmall 20000] [--nremote 2000]
+# Benchmark the transfer overhead of lib_multiproc.multiprocManager: every task receives a complex64
+# array and sends back an array of the same size, the work done on the data is negligible
+# so the time per task is dominated by moving the arrays through the queues or the shared memory
+# Then many tiny tasks (e.g. one per baseline) are sent one by one and in batches
+# and a script with several steps is run with new processes for each step or with a single pool
+# Finally the tasks are served over TCP on localhost to workers started with lib_multiproc.py -c (as on another node)
+
+import os, sys, time, argparse, logging, subprocess
+import numpy as np
+
+import lib_multiproc
+from lib_multiproc import multiprocManager, multiprocPool
+
+def echo(i, data, outQueue=None):
+    """
+    Return the data with a negligible amount of work
+    """
+    data_out = data.copy()
+    data_out[0] += 1
+    outQueue.put([i, data_out])
+
+def square(i, outQueue=None):
+    outQueue.put(i*i)
+
+def run_small(ntasks, ncpu, batch):
+    """
+    Send ntasks tiny tasks one by one (batch=False) or with put_many(), return the time per task
+    """
+    start = time.time()
+    mpm = multiprocManager(ncpu, square)
+    if batch:
+        mpm.put_many([[i] for i in range(ntasks)])
+    else:
+        for i in range(ntasks):
+            mpm.put([i])
+    results = list(mpm.get(ordered=True))
+    mpm.wait()
+    assert results == [i*i for i in range(ntasks)]
+    return (time.time() - start) / ntasks
+
+def run_steps(nsteps, ncpu, pool):
+    """
+    Run nsteps steps of ncpu tiny tasks each with a new multiprocManager or with a single multiprocPool
+    Return the time per step
+    """
+    start = time.time()
+    if pool:
+        with multiprocPool(ncpu) as pool:
+            for step in range(nsteps):
+                pool.submit_many(square, [[i] for i in range(ncpu)])
+                list(pool.get())
+    else:
+        for step in range(nsteps):
+            mpm = multiprocManager(ncpu, square)
+            mpm.put_many([[i] for i in range(ncpu)])
+            list(mpm.get())
+            mpm.wait()
+    return (time.time() - start) / nsteps
+
+def run_remote(ntasks, ncpu):
+    """
+    Send ntasks tiny tasks to ncpu worker processes connected to a coordinator on localhost
+    Return the time per task
+    """
+    start = time.time()
+    authkey = os.urandom(16).hex()
+    mpm = multiprocManager(0, square, address=('127.0.0.1', 0), authkey=authkey, remote_procs=ncpu)
+    workers = subprocess.Popen([sys.executable, os.path.abspath(lib_multiproc.__file__), '-c', '127.0.0.1:%i' % mpm.address[1], \
+            '-a', authkey, '-n', str(ncpu)])
+    try:
+        mpm.put_many([[i] for i in range(ntasks)])
+        results = list(mpm.get(ordered=True))
+        mpm.wait()
+    except:
+        workers.kill()
+        raise
+    # the workers stop when the coordinator is closed
+    assert workers.wait(timeout=60) == 0
+    assert results == [i*i for i in range(ntasks)]
+    return (time.time() - start) / ntasks
+
+def run(data, ntasks, ncpu, shared):
+    """
+    Send ntasks copies of data to the workers and collect the results
+    Return the time per task and the maximum difference of the results
+    """
+    start = time.time()
+    mpm = multiprocManager(ncpu, echo, shared=shared)
+    for i in range(ntasks):
+        mpm.put([i, data])
+    err = 0.
+    for i, data_out in mpm.get():
+        err = max(err, np.max(np.abs(data_out[1:] - data[1:])))
+    mpm.wait()
+    return (time.time() - start) / ntasks, err
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the lib_multiproc.py queue and shared memory transfers')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 16, 128], help='Array sizes in MB (default: 1 16 128)')
+    parser.add_argument('--ntasks', type=int, default=8, help='Number of tasks per size (default: 8)')
+    parser.add_argument('--ncpu', type=int, default=2, help='Number of worker processes (default: 2)')
+    parser.add_argument('--nsmall', type=int, default=20000, help='Number of tiny tasks (default: 20000)')
+    parser.add_argument('--nsteps', type=int, default=50, help='Number of steps of a script (default: 50)')
+    parser.add_argument('--nremote', type=int, default=2000, help='Number of tiny tasks for the workers on localhost (default: 2000)')
+    args = parser.parse_args()
+    logging.root.setLevel(logging.INFO)
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        nvis = int(size * 2**20 / 8)
+        data = (rng.normal(size=nvis) + 1j*rng.normal(size=nvis)).astype(np.complex64)
+        t_queue, err_queue = run(data, args.ntasks, args.ncpu, False)
+        t_shared, err_shared = run(data, args.ntasks, args.ncpu, True)
+        print('%7.1f MB  queue: %8.1f ms/task  shared: %8.1f ms/task  speedup: %5.1fx  max difference: %.1e' % \
+                (size, 1e3*t_queue, 1e3*t_shared, t_queue/t_shared, max(err_queue, err_shared)))
+
+    t_put = run_small(args.nsmall, args.ncpu, False)
+    t_batch = run_small(args.nsmall, args.ncpu, True)
+    print('%7i tiny tasks  put: %8.3f ms/task  put_many: %8.3f ms/task  speedup: %5.1fx' % \
+            (args.nsmall, 1e3*t_put, 1e3*t_batch, t_put/t_batch))
+
+    t_new = run_steps(args.nsteps, args.ncpu, False)
+    t_pool = run_steps(args.nsteps, args.ncpu, True)
+    print('%7i steps  new processes: %8.3f ms/step  pool: %8.3f ms/step  speedup: %5.1fx' % \
+            (args.nsteps, 1e3*t_new, 1e3*t_pool, t_new/t_pool))
+
+    t_local = run_small(args.nremote, args.ncpu, True)
+    t_remote = run_remote(args.nremote, args.ncpu)
+    print('%7i tiny tasks  local: %8.3f ms/task  localhost workers: %8.3f ms/task  slowdown: %5.1fx' % \
+            (args.nremote, 1e3*t_local, 1e3*t_remote, t_remote/t_local))
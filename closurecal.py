@@ -21,6 +21,7 @@ import os, sys, logging, itertools
 import pyrap.tables as pt
 import numpy as np
 import scipy.optimize
+from lib_timer import profile_script
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -139,6 +140,8 @@ if plotph or plotamp or plotavg or plotall:
     fig.subplots_adjust(wspace=0)
 
 
+profile_script() # with $SCRIPTS_PROFILE
+
 # get antenna names
 logging.info('Get antenna names')
 tant = pt.table(ms+'/ANTENNA', readonly=True, ack=False)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# Helpers shared by the scripts that process MSs (BLsmooth.py, reweight.py)
+
+import os, glob
+
+def get_dm_mtime(ms_file, seqnrs):
+    """
+    Return the last modification time of the files of the storage managers seqnrs of an MS
+    Only table.f<seqnr>, table.f<seqnr>i and table.f<seqnr>_* belong to a manager (table.f1* would also match table.f10)
+    Return None if the MS has no such files (e.g. a reference or concat table, whose data are stored in other tables):
+    its content cannot be dated, so it must not be cached
+    """
+    files = []
+    for seqnr in seqnrs:
+        for pattern in ['table.f%i' % seqnr, 'table.f%ii' % seqnr, 'table.f%i_*' % seqnr]:
+            files += glob.glob(os.path.join(ms_file, pattern))
+    if not files: return None
+    return max([os.path.getmtime(f) for f in files])
@@ -30,13 +30,273 @@
 # mpm.wait()
 # for r in mpm.get():
 #     print "funct_output:", r
+#
+# put() returns the id of the task: with mpm.get(ordered=True) the outputs are returned in the order of the
+# tasks (not of completion) and with mpm.get(ids=True) as [task_id, funct_output]. An exception in funct is
+# raised in the caller by get() or wait() as WorkerError with the traceback of the worker.
+# Many small tasks can be sent with mpm.put_many([funct_params1, funct_params2, ...]) which groups them in
+# batches (a few per process) to save the communication overhead of each task.
+#
+# multiprocPool(ncpu) keeps the processes alive to run different functions (pool.submit(funct, [funct_params]))
+# until close(), e.g. for the steps of a script, and worker_cache() keeps objects (e.g. open MSs) in each process.
+#
+# With mpm.put([funct_params], memory=nbytes) tasks declare their memory footprint: they are started by get()/wait()
+# the biggest first, only while the running ones fit in max_memory (default: 80% of the available memory).
+#
+# With multiprocManager(ncpu, funct, address=('', port), authkey='secret') the tasks are served over TCP and
+# processes on other nodes (sharing the filesystem) can run them, e.g. in a cluster job:
+#     qsub_waiter_lei.sh 8 lib_multiproc.py -c <coordinator host>:<port> -a secret -n 8
+# The remote processes stop when the coordinator calls wait(). The functions must be importable on the other nodes.
+#
+# With multiprocManager(ncpu, funct, shared=True) numpy arrays (larger than shared_min_size bytes) in the parameters
+# and in the outputs are passed through shared memory instead of being pickled: funct receives views of the
+# arrays (valid until it returns) and get() returns arrays copied out of the shared memory once.
 
-import sys
+import os, sys, time
+import queue
+import heapq
+import socket
+import collections
 import logging
+import traceback
+import importlib.util
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.managers import BaseManager
+import numpy as np
+
+
+class SharedArray(object):
+    """
+    Handle of a numpy array copied in a shared memory block, it is sent through the queues instead of the array
+    The process that uses the array (attach) is responsible of releasing the block (release)
+    """
+
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)[...] = array
+        self.name = shm.name
+        shm.close()
+        self.shm = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype, 'shm': None}
+
+    def attach(self):
+        """
+        Return a view of the array in the shared memory
+        """
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def release(self):
+        """
+        Free the shared memory block, views of the array must not be used anymore
+        """
+        if self.shm is None:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                # already released
+                return
+        try:
+            self.shm.close()
+        except BufferError:
+            # a view is still referenced: the memory is freed when the process ends
+            logging.debug('Shared array %s still in use.' % self.name)
+        self.shm.unlink()
+
+
+def share(obj, min_size, handles=None):
+    """
+    Replace numpy arrays larger than min_size bytes in obj (also inside lists, tuples and dicts) with SharedArray
+    The new SharedArray are appended to handles if given
+    """
+    if isinstance(obj, np.ndarray) and obj.nbytes >= min_size and not obj.dtype.hasobject:
+        handle = SharedArray(obj)
+        if handles is not None: handles.append(handle)
+        return handle
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([share(o, min_size, handles) for o in obj])
+    if isinstance(obj, dict):
+        return dict([(k, share(o, min_size, handles)) for k, o in obj.items()])
+    return obj
+
+
+def unshare(obj, handles, copy=False):
+    """
+    Replace SharedArray in obj with views of the arrays (or copies if copy, the shared memory is then released)
+    The handles of the views are appended to handles, to be released when the views are not used anymore
+    """
+    if isinstance(obj, SharedArray):
+        array = obj.attach()
+        if copy:
+            array = array.copy()
+            obj.release()
+        else:
+            handles.append(obj)
+        return array
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([unshare(o, handles, copy) for o in obj])
+    if isinstance(obj, dict):
+        return dict([(k, unshare(o, handles, copy)) for k, o in obj.items()])
+    return obj
+
+
+class WorkerError(Exception):
+    """
+    A task failed or a process died in multiprocManager
+    """
+    pass
+
+
+_worker_cache = {} # pid: {key: object}, see worker_cache()
+
+
+def get_available_memory():
+    """
+    Return the memory available for new processes in bytes (MemAvailable of /proc/meminfo, free memory elsewhere)
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def worker_cache(key, create):
+    """
+    Return the object stored with key in the cache of this process, it is made with create() the first time
+    The objects are kept across the tasks run by a process of multiprocPool (and closed when it stops), e.g. to
+    keep a MS open: ms = worker_cache(('ms', ms_file), lambda: table(ms_file, ack=False))
+    """
+    # the processes are forked: objects cached by the parent are not shared with the children
+    cache = _worker_cache.setdefault(os.getpid(), {})
+    if key not in cache:
+        cache[key] = create()
+    return cache[key]
+
+
+def clear_worker_cache():
+    """
+    Close (if they have a close() method) and forget the objects cached by this process
+    """
+    cache = _worker_cache.pop(os.getpid(), {})
+    for key, obj in cache.items():
+        if hasattr(obj, 'close'):
+            try:
+                obj.close()
+            except Exception:
+                logging.warning('Cannot close cached %s.' % str(key))
 
 
-class multiprocManager(object):
+_served_queues = {} # name: queue.Queue, in the server process of queueManager
+_main_modules = {} # path: module, scripts imported by mainFunct
+
+
+def get_served_queue(name):
+    """
+    Return the queue called name, served by queueManager (it runs in the server process)
+    """
+    if name not in _served_queues:
+        _served_queues[name] = queue.Queue()
+    return _served_queues[name]
+
+
+class queueManager(BaseManager):
+    """
+    Server of the task and result queues of a multiprocPool, for workers on other nodes
+    """
+    pass
+
+queueManager.register('get_queue', callable=get_served_queue)
+
+
+def connect(address, authkey, timeout=60):
+    """
+    Connect to the queues of a multiprocPool served on address=(host, port), retrying for timeout seconds
+    Return the task and the result queues
+    """
+    manager = queueManager(address=address, authkey=authkey)
+    start = time.time()
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if time.time() - start > timeout:
+                raise
+            time.sleep(1)
+    return manager.get_queue('tasks'), manager.get_queue('results')
+
+
+def run_workers(address, authkey, procs=1, timeout=60):
+    """
+    Run procs worker processes for the multiprocPool served on address=(host, port), until it is closed
+    """
+    threads = [multiprocPool.remoteThread(address, authkey, timeout) for proc in range(procs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class mainFunct(object):
+    """
+    Reference to a function of the script run as __main__, the processes on other nodes import it from its path
+    """
+
+    def __init__(self, funct):
+        self.path = os.path.abspath(sys.modules['__main__'].__file__)
+        self.name = funct.__name__
+
+    def __call__(self, *args, **kwargs):
+        module = sys.modules['__main__']
+        if os.path.abspath(getattr(module, '__file__', '')) != self.path:
+            if self.path not in _main_modules:
+                # imported with another name, so that its main section is not run
+                spec = importlib.util.spec_from_file_location('multiproc_main%i' % len(_main_modules), self.path)
+                _main_modules[self.path] = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(_main_modules[self.path])
+            module = _main_modules[self.path]
+        return getattr(module, self.name)(*args, **kwargs)
+
+
+class multiprocPool(object):
+    """
+    Pool of processes kept alive to run tasks of any function, to be used as a context manager:
+    with multiprocPool(ncpu) as pool:
+        pool.submit(funct1, [funct1_params])
+        for r in pool.get(): ...
+        pool.submit_many(funct2, [[funct2_params], ...])
+        for r in pool.get(): ...
+    A failed task raises WorkerError in get() or join(), the other tasks go on
+    Tasks can declare their memory footprint (submit(funct, args, memory=bytes)): they are started by get() or join(),
+    the biggest first, while the footprints of the running ones fit in max_memory
+    With address=(host, port) the queues are served over TCP and workers on other nodes can connect (run_workers())
+    """
+
+    terminate_on_error = False
+
+    class taskQueue(object):
+        """
+        Output queue given to funct, the outputs are labelled with the id of the task and collected in messages
+        """
+
+        def __init__(self, messages, task_id, shared_min_size=None):
+            self.messages = messages
+            self.task_id = task_id
+            self.shared_min_size = shared_min_size
+
+        def put(self, obj):
+            if self.shared_min_size is not None:
+                obj = share(obj, self.shared_min_size)
+            self.messages.append(['output', self.task_id, obj])
 
     class multiThread(multiprocessing.Process):
         """
@@ -44,68 +304,383 @@ class multiprocManager(object):
         return in the output queue
         """
 
-        def __init__(self, inQueue, outQueue, funct):
+        def __init__(self, inQueue, outQueue, shared_min_size=None):
             multiprocessing.Process.__init__(self)
             self.inQueue = inQueue
             self.outQueue = outQueue
-            self.funct = funct
+            self.shared_min_size = shared_min_size
 
         def run(self):
 
             while True:
-                parms = self.inQueue.get()
+                tasks = self.inQueue.get()
 
                 # poison pill
-                if parms is None:
-                    self.inQueue.task_done()
+                if tasks is None:
                     break
 
-                self.funct(*parms, outQueue=self.outQueue)
-                self.inQueue.task_done()
+                # the messages of all the tasks of a batch are sent together
+                messages = []
+                for task_id, funct, parms in tasks:
+                    self.run_task(task_id, funct, parms, messages)
+                self.outQueue.put(messages)
 
+            clear_worker_cache()
 
-    def __init__(self, procs=1, funct=None):
+        def run_task(self, task_id, funct, parms, messages):
+            """
+            Run funct for one task, its outputs are followed by 'done' or by the traceback if it failed
+            """
+            handles = []
+            try:
+                if self.shared_min_size is not None:
+                    parms = unshare(parms, handles)
+                funct(*parms, outQueue=multiprocPool.taskQueue(messages, task_id, self.shared_min_size))
+                messages.append(['done', task_id, None])
+            except Exception:
+                messages.append(['error', task_id, traceback.format_exc()])
+            finally:
+                del parms
+                for handle in handles:
+                    handle.release()
+
+    class remoteThread(multiThread):
+        """
+        Working thread that connects to the queues served by a multiprocPool (also from another node)
+        """
+
+        def __init__(self, address, authkey, timeout=60):
+            multiprocPool.multiThread.__init__(self, None, None)
+            self.address = address
+            self.authkey = authkey
+            self.timeout = timeout
+
+        def run(self):
+            self.inQueue, self.outQueue = connect(self.address, self.authkey, self.timeout)
+            try:
+                multiprocPool.multiThread.run(self)
+            except (EOFError, OSError):
+                # the pool has been closed
+                logging.debug('Connection to %s:%i closed.' % tuple(self.address))
+                clear_worker_cache()
+
+    def __init__(self, procs=1, shared=False, shared_min_size=2**20, batch=1, max_memory=None, memory_fraction=0.8, \
+            address=None, authkey=None, remote_procs=0):
         """
-        Manager for multiprocessing
         procs: number of processors
-        funct: function to parallelize / note that the last parameter of this function must be the outQueue
-        and it will be linked to the output queue
+        shared: pass numpy arrays of at least shared_min_size bytes through shared memory instead of the queues
+        batch: number of tasks of submit() sent together to a process
+        max_memory: memory budget in bytes of the tasks declaring a footprint (default: memory_fraction of the available memory)
+        address: (host, port) where the queues are served to the workers of other nodes (port 0: any free port), procs
+        processes are also started here (they can be 0)
+        authkey: key the workers need to connect (default: $MULTIPROC_AUTHKEY)
+        remote_procs: number of processes expected on other nodes, used to size the batches and to stop them
         """
         self.procs = procs
+        self.nprocs = max(1, procs + remote_procs)
+        self.batch = batch
+        if max_memory is None:
+            max_memory = memory_fraction * get_available_memory()
+        self.max_memory = max_memory
         self._threads = []
-        self.inQueue = multiprocessing.JoinableQueue()
-        self.outQueue = multiprocessing.Queue()
+        self._server = None
+        if address is None:
+            self.inQueue = multiprocessing.Queue()
+            self.outQueue = multiprocessing.Queue()
+        else:
+            if shared:
+                raise ValueError('Shared memory cannot be used by workers on other nodes.')
+            if authkey is None:
+                authkey = os.environ.get('MULTIPROC_AUTHKEY')
+            if authkey is None:
+                raise ValueError('An authkey is needed to serve the tasks.')
+            self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+            self._server = queueManager(address=address, authkey=self.authkey)
+            self._server.start()
+            self.address = self._server.address
+            self.inQueue = self._server.get_queue('tasks')
+            self.outQueue = self._server.get_queue('results')
+            logging.info('Serving tasks on %s:%i.' % (socket.gethostname(), self.address[1]))
+        self.remote_procs = remote_procs
         self.runs = 0
-        
+        self._tasks = [] # tasks waiting to be sent in a batch
+        self._todo = set() # ids of the tasks sent and not finished
+        self._done = set() # ids of the tasks finished whose outputs are not returned by get() yet
+        self._outputs = collections.deque() # [task_id, output] received and not returned by get() yet
+        self._shared = {} # task_id: [SharedArray] of the parameters of the tasks not finished
+        self._waiting = [] # heap of [-memory, task_id, funct, args] of the tasks with a footprint not started
+        self._running = {} # task_id: memory of the tasks with a footprint started and not finished
+        self.shared_min_size = shared_min_size if shared else None
+        if shared:
+            # workers must share the tracker of the shared memory blocks with this process
+            resource_tracker.ensure_running()
+
         logging.debug('Spawning %i threads...' % self.procs)
         for proc in range(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
+            if self._server is None:
+                t = self.multiThread(self.inQueue, self.outQueue, self.shared_min_size)
+            else:
+                t = self.remoteThread(self.address, self.authkey)
             self._threads.append(t)
             t.start()
 
-    def put(self, args):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, value, tb):
+        if exit_type is None:
+            self.close()
+        else:
+            # do not wait for the tasks if the caller failed
+            self._terminate()
+
+    def submit(self, funct, args, memory=None):
         """
-        Parameters to give to the next jobs sent into queue
+        Run funct(*args, outQueue=...) in a process
+        memory: estimated memory footprint of the task in bytes, the task is then started by get() or join()
+        Return the id of the task
         """
-        self.inQueue.put(args)
+        task_id = self._add(funct, args, memory)
+        if len(self._tasks) >= self.batch:
+            self._send()
+        return task_id
+
+    def submit_many(self, funct, args_list, batch=None, memory=None):
+        """
+        Send many tasks grouped in batches, by default of a size giving about 4 batches per process
+        memory: list of the memory footprints of the tasks, they are then not grouped
+        Return the ids of the tasks
+        """
+        if batch is None:
+            batch = max(1, int(np.ceil(len(args_list) / (4. * self.nprocs))))
+        if memory is None:
+            memory = [None] * len(args_list)
+        self._send()
+        task_ids = []
+        for args, task_memory in zip(args_list, memory):
+            task_ids.append(self._add(funct, args, task_memory))
+            if len(self._tasks) >= batch:
+                self._send()
+        self._send()
+        return task_ids
+
+    def _add(self, funct, args, memory=None):
+        """
+        Add a task to the next batch (or to the waiting tasks if it has a memory footprint), return its id
+        """
+        task_id = self.runs
+        if self._server is not None and getattr(funct, '__module__', None) == '__main__':
+            funct = mainFunct(funct)
+        if self.shared_min_size is not None:
+            self._shared[task_id] = []
+            args = share(args, self.shared_min_size, self._shared[task_id])
+        if memory is None:
+            self._tasks.append([task_id, funct, args])
+        else:
+            heapq.heappush(self._waiting, [-memory, task_id, funct, args])
+        self._todo.add(task_id)
         self.runs += 1
+        return task_id
 
-    def get(self):
+    def _send(self):
         """
-        Return all the results as an iterator
+        Send the tasks waiting for a batch to be complete and the tasks with a footprint that fit in memory
         """
-        # NOTE: do not use queue.empty() check which is unreliable
-        # https://docs.python.org/2/library/multiprocessing.html
-        for run in range(self.runs):
-            yield self.outQueue.get()
+        if self._tasks:
+            self.inQueue.put(self._tasks)
+            self._tasks = []
 
-    def wait(self):
+        # the biggest task first, a task does not overtake a bigger one that does not fit
+        while self._waiting and len(self._running) < self.nprocs:
+            memory = -self._waiting[0][0]
+            if sum(self._running.values()) + memory > self.max_memory:
+                if self._running:
+                    break
+                logging.warning('Task footprint (%.2f GB) larger than the memory budget (%.2f GB).' % (memory/1024.**3, self.max_memory/1024.**3))
+            memory, task_id, funct, args = heapq.heappop(self._waiting)
+            self._running[task_id] = -memory
+            self.inQueue.put([[task_id, funct, args]])
+
+    def _receive(self):
         """
-        Send poison pills to jobs and wait for them to finish
-        The join() should kill all the processes
+        Wait for the next messages of a worker
+        Raise WorkerError if a task failed or if a process died
+        """
+        while True:
+            try:
+                messages = self.outQueue.get(timeout=1)
+                break
+            except queue.Empty:
+                dead = [t for t in self._threads if not t.is_alive()]
+                if dead:
+                    self._terminate()
+                    raise WorkerError('Process %s died (exit code %s) while running tasks.' % (dead[0].name, dead[0].exitcode))
+
+        errors = []
+        for kind, task_id, obj in messages:
+            if kind != 'output':
+                self._shared.pop(task_id, None)
+                self._running.pop(task_id, None)
+            if kind == 'error':
+                self._todo.discard(task_id)
+                errors.append('Task %i failed:\n%s' % (task_id, obj))
+            elif kind == 'done':
+                self._todo.discard(task_id)
+                self._done.add(task_id)
+            else:
+                if self.shared_min_size is not None:
+                    obj = unshare(obj, [], copy=True)
+                self._outputs.append([task_id, obj])
+        # start the tasks that now fit in memory
+        self._send()
+        if errors:
+            if self.terminate_on_error:
+                self._terminate()
+            raise WorkerError('\n'.join(errors))
+
+    def _terminate(self):
+        """
+        Stop all the processes, the tasks not finished are lost
         """
         for t in self._threads:
+            t.terminate()
+            t.join()
+        for handles in self._shared.values():
+            for handle in handles:
+                handle.release()
+        self._shared = {}
+        # release the outputs already sent by the processes
+        while self.shared_min_size is not None:
+            try:
+                messages = self.outQueue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            for kind, task_id, obj in messages:
+                handles = []
+                unshare(obj, handles)
+                for handle in handles:
+                    handle.release()
+        self._threads = []
+        if self._server is not None:
+            # the remote workers stop when the connection is closed
+            self._server.shutdown()
+            self._server = None
+        self._tasks = []
+        self._waiting = []
+        self._running = {}
+        self._todo.clear()
+
+    def get(self, ordered=False, ids=False):
+        """
+        Return all the results as an iterator
+        ordered: return the results in the order of the tasks instead of the order of completion
+        ids: return [task_id, result]
+        """
+        self._send()
+        pending = collections.deque(sorted(self._todo | self._done)) # tasks to return, for ordered
+        outputs = {} # task_id: [outputs], for ordered
+        while True:
+            while self._outputs:
+                task_id, obj = self._outputs.popleft()
+                if ids: obj = [task_id, obj]
+                if ordered: outputs.setdefault(task_id, []).append(obj)
+                else: yield obj
+            if ordered:
+                while pending and pending[0] in self._done:
+                    task_id = pending.popleft()
+                    self._done.discard(task_id)
+                    for obj in outputs.pop(task_id, []):
+                        yield obj
+            else:
+                self._done.clear()
+            if not self._todo:
+                break
+            self._receive()
+
+    def join(self):
+        """
+        Wait for all the tasks to finish, results not yet returned are kept for get()
+        """
+        self._send()
+        while self._todo:
+            self._receive()
+
+    def close(self):
+        """
+        Wait for all the tasks to finish, then send poison pills to jobs and wait for them to finish
+        """
+        self.join()
+        for proc in range(len(self._threads) + self.remote_procs):
             self.inQueue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+class multiprocManager(multiprocPool):
+    """
+    Pool of processes running a single function, stopped by wait()
+    It is stopped also when a task fails, not to leave processes waiting if the caller does not call wait()
+    """
+
+    terminate_on_error = True
+
+    def __init__(self, procs=1, funct=None, shared=False, shared_min_size=2**20, batch=1, max_memory=None, memory_fraction=0.8, \
+            address=None, authkey=None, remote_procs=0):
+        """
+        Manager for multiprocessing
+        procs: number of processors
+        funct: function to parallelize / note that the last parameter of this function must be the outQueue
+        and it will be linked to the output queue
+        shared: pass numpy arrays of at least shared_min_size bytes through shared memory instead of the queues
+        batch: number of tasks of put() sent together to a process
+        max_memory: memory budget in bytes of the tasks declaring a footprint (default: memory_fraction of the available memory)
+        address, authkey, remote_procs: serve the tasks to workers on other nodes, see multiprocPool
+        """
+        self.funct = funct
+        multiprocPool.__init__(self, procs, shared, shared_min_size, batch, max_memory, memory_fraction, \
+                address, authkey, remote_procs)
+
+    def put(self, args, memory=None):
+        """
+        Parameters to give to the next jobs sent into queue
+        memory: estimated memory footprint of the task in bytes, the task is then started by get() or wait()
+        Return the id of the task
+        """
+        return self.submit(self.funct, args, memory)
+
+    def put_many(self, args_list, batch=None, memory=None):
+        """
+        Send many tasks grouped in batches, by default of a size giving about 4 batches per process
+        memory: list of the memory footprints of the tasks, they are then not grouped
+        Return the ids of the tasks
+        """
+        return self.submit_many(self.funct, args_list, batch, memory)
+
+    def wait(self):
+        """
+        Wait for all the tasks to finish (results not yet returned are kept for get())
+        then send poison pills to jobs and wait for them to finish
+        """
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run worker processes for a multiprocPool/multiprocManager served on another node')
+    parser.add_argument('-c', '--connect', required=True, help='Address of the coordinator: host:port')
+    parser.add_argument('-a', '--authkey', default=os.environ.get('MULTIPROC_AUTHKEY'), help='Key of the coordinator (default: $MULTIPROC_AUTHKEY)')
+    parser.add_argument('-n', '--ncpu', type=int, default=1, help='Number of worker processes (default: 1)')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='Seconds to wait for the coordinator to start (default: 60)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
-        # wait for all jobs to finish
-        self.inQueue.join()
+    if args.authkey is None:
+        logging.error('An authkey is needed to connect.')
+        sys.exit(1)
+    host, port = args.connect.rsplit(':', 1)
+    logging.info('Running %i worker processes for %s.' % (args.ncpu, args.connect))
+    run_workers((host, int(port)), args.authkey.encode(), args.ncpu, args.timeout)
@@ -17,8 +17,219 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+# USAGE:
+# with Timer('step'):                 # or as decorator: @Timer('step')
+#     with Timer('substep'):
+#         pass
+#
+# Each block accumulates calls, wall and cpu time under its path (e.g. 'step/substep'), a summary table is
+# logged at exit and with $TIMER_JSON=file.json the statistics are also saved (see save_json()).
+# With $TIMER_RESOURCES=1 each block also records the change and the peak of the resident memory of the process
+# and the bytes it read/wrote (from /proc/self, Linux only). The peak of a block is measured resetting the
+# high-water mark of the process (VmHWM) at its start: VmHWM then no longer gives the peak of the whole run,
+# use get_peak() instead.
+# Compare two runs with: lib_timer.py run1.json run2.json
+#
+# With $SCRIPTS_PROFILE=cprofile (or sample) the code in a Profile block (or after profile_script()) is profiled,
+# the result is saved as <name>.pstats (or <name>.collapsed, stacks for flamegraph.pl/speedscope)
+
+import os, sys, time, json, atexit, logging, threading, functools
+
+_stats = {} # path: [calls, wall, wall max, cpu, cpu max]
+_resources = {} # path: [rss change, rss peak, read, write, disk read, disk write] (bytes), with $TIMER_RESOURCES
+_local = threading.local() # stack of the running timers of each thread
+_peak = [0] # highest VmHWM before it was reset (bytes)
+_profiles = [] # Profile of profile_script(), stopped before the summary
+resources = os.environ.get('TIMER_RESOURCES', '0').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+def get_resources():
+    """
+    Return the resident memory, its high-water mark, bytes read, written, read from disk and written to disk
+    by this process
+    """
+    usage = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+                usage[line[:5]] = int(line.split()[1]) * 1024
+    with open('/proc/self/io') as io:
+        for line in io:
+            key, value = line.split(':')
+            usage[key] = int(value)
+    return [usage['VmRSS'], usage['VmHWM'], usage['rchar'], usage['wchar'], usage['read_bytes'], usage['write_bytes']]
+
+def reset_peak(peak):
+    """
+    Reset the high-water mark of the resident memory of this process to the current value
+    peak: the high-water mark before the reset, kept for get_peak()
+    Return False if not possible
+    """
+    _peak[0] = max(_peak[0], peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except IOError:
+        return False
+
+def get_peak():
+    """
+    Return the peak resident memory of this process (bytes), also if the high-water mark was reset by the timers
+    """
+    return max(_peak[0], get_resources()[1])
+
+def get_stats():
+    """
+    Return the statistics of all steps as a dict path: {calls, wall, wall_mean, wall_max, cpu, cpu_mean, cpu_max}
+    With $TIMER_RESOURCES also rss (total change), rss_peak, read, write, disk_read, disk_write in bytes
+    """
+    stats = {}
+    for path, (calls, wall, wall_max, cpu, cpu_max) in _stats.items():
+        stats[path] = {'calls': calls, 'wall': wall, 'wall_mean': wall/calls, 'wall_max': wall_max, \
+                       'cpu': cpu, 'cpu_mean': cpu/calls, 'cpu_max': cpu_max}
+        if path in _resources:
+            stats[path].update(zip(['rss', 'rss_peak', 'read', 'write', 'disk_read', 'disk_write'], _resources[path]))
+    return stats
+
+def save_json(filename):
+    """
+    Save the statistics of all steps, with the command line and the date, in a json file
+    """
+    with open(filename, 'w') as f:
+        json.dump({'argv': sys.argv, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': os.uname()[1], \
+                   'timers': get_stats()}, f, indent=1, sort_keys=True)
+
+def summary(log=None):
+    """
+    Log a table with the statistics of all steps, nested steps follow their parents
+    """
+    if log is None: log = logging
+    if not _stats: return
+    width = max([len(path) for path in _stats])
+    header = '%-*s %7s %10s %10s %10s %10s' % (width, 'Step', 'calls', 'wall [s]', 'mean [s]', 'max [s]', 'cpu [s]')
+    if _resources: header += ' %10s %10s %10s %10s' % ('rss [MB]', 'peak [MB]', 'read [MB]', 'write [MB]')
+    log.info(header)
+    for path in sorted(_stats, key=lambda path: path.split('/')):
+        calls, wall, wall_max, cpu, cpu_max = _stats[path]
+        line = '%-*s %7i %10.3f %10.3f %10.3f %10.3f' % (width, path, calls, wall, wall/calls, wall_max, cpu)
+        if path in _resources:
+            line += ' %+10.1f %10.1f %10.1f %10.1f' % tuple([r/1024.**2 for r in _resources[path][:4]])
+        log.info(line)
+
+def _at_exit():
+    # the profile of the script does not include the summary
+    for profile in _profiles:
+        profile.stop()
+    summary()
+    if os.environ.get('TIMER_JSON'):
+        save_json(os.environ['TIMER_JSON'])
 
-import time, logging
+class stackSampler(threading.Thread):
+    """
+    Thread that samples the stack of another thread every interval seconds
+    The stacks are weighted by the wall time since the previous sample (in us), so that calls that hold
+    the interpreter longer than the interval are not underestimated
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        threading.Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {} # 'outer;...;inner': us
+        self.done = threading.Event()
+
+    def run(self):
+        last = time.time()
+        while not self.done.wait(self.interval):
+            now = time.time()
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + int(1e6 * (now - last))
+            last = now
+
+    def save(self, filename):
+        """
+        Save the stacks in the collapsed format: one 'outer;...;inner us' line per stack
+        """
+        with open(filename, 'w') as f:
+            for stack in sorted(self.stacks):
+                f.write('%s %i\n' % (stack, self.stacks[stack]))
+
+class Profile(object):
+    """
+    Profile a block of code (context manager or decorator) if $SCRIPTS_PROFILE is set to:
+    cprofile: deterministic profile saved in outdir/name.pstats (python -m pstats, snakeviz, ...)
+    sample: the stack is sampled every $SCRIPTS_PROFILE_INTERVAL s (default: 0.005), saved in outdir/name.collapsed
+    """
+
+    def __init__(self, name='profile', outdir='.', mode=None, log=None):
+        if log is None: self.log = logging
+        else: self.log = log
+        if mode is None: mode = os.environ.get('SCRIPTS_PROFILE', '')
+        self.mode = mode
+        self.name = name
+        self.outdir = outdir
+        self.profiler = None
+
+    def __call__(self, funct):
+        """
+        Use as a decorator: profile every call of funct
+        """
+        @functools.wraps(funct)
+        def profiled(*args, **kwargs):
+            with Profile(self.name, self.outdir, self.mode, self.log):
+                return funct(*args, **kwargs)
+        return profiled
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exit_type, value, tb):
+        self.stop()
+
+    def start(self):
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == 'sample':
+            self.profiler = stackSampler(threading.get_ident(), float(os.environ.get('SCRIPTS_PROFILE_INTERVAL', 0.005)))
+            self.profiler.start()
+        elif self.mode:
+            self.log.warning('Unknown profiler %s (use cprofile or sample).' % self.mode)
+
+    def stop(self):
+        if self.profiler is None: return
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+            filename = os.path.join(self.outdir, self.name + '.pstats')
+            self.profiler.dump_stats(filename)
+        else:
+            self.profiler.done.set()
+            self.profiler.join()
+            filename = os.path.join(self.outdir, self.name + '.collapsed')
+            self.profiler.save(filename)
+        self.profiler = None
+        self.log.info('Profile saved in %s.' % filename)
+
+def profile_script(outdir='.'):
+    """
+    Profile the rest of a script, until it exits, if $SCRIPTS_PROFILE is set
+    The profile is named as the script, e.g. outdir/spidxmap.pstats
+    """
+    if not os.environ.get('SCRIPTS_PROFILE'): return None
+    profile = Profile(os.path.splitext(os.path.basename(sys.argv[0]))[0], outdir)
+    profile.start()
+    _profiles.append(profile)
+    atexit.register(profile.stop)
+    return profile
 
 class Timer(object):
     """
@@ -34,13 +245,69 @@ class Timer(object):
         else: self.log = log
         self.step = step
 
+    def __call__(self, funct):
+        """
+        Use as a decorator: time every call of funct
+        """
+        @functools.wraps(funct)
+        def timed(*args, **kwargs):
+            with Timer(self.step, self.log):
+                return funct(*args, **kwargs)
+        return timed
+
     def __enter__(self):
+        if not _stats: atexit.register(_at_exit)
+        stack = _local.__dict__.setdefault('stack', [])
+        self.path = '/'.join([timer.step for timer in stack] + [self.step])
+        stack.append(self)
+        _stats.setdefault(self.path, [0, 0., 0., 0., 0.])
         self.log.debug("--> Starting \'" + self.step + "\'.")
+        if resources:
+            # the peak before this block is kept for the parent block
+            self.usage = get_resources()
+            self.peak = self.usage[1]
+            if stack[:-1]: stack[-2].peak = max(stack[-2].peak, self.usage[1])
+            if reset_peak(self.usage[1]): self.peak = self.usage[0]
         self.start = time.time()
-        self.startcpu = time.clock()
+        self.startcpu = time.process_time()
 
     def __exit__(self, exit_type, value, tb):
 
+        wall = time.time() - self.start
+        cpu = time.process_time() - self.startcpu
+        stack = _local.stack
+        stack.pop()
+        stats = _stats[self.path]
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] = max(stats[2], wall)
+        stats[3] += cpu
+        stats[4] = max(stats[4], cpu)
+
+        if resources:
+            usage = get_resources()
+            self.peak = max(self.peak, usage[1])
+            if stack: stack[-1].peak = max(stack[-1].peak, self.peak)
+            res = _resources.setdefault(self.path, [0, 0, 0, 0, 0, 0])
+            res[0] += usage[0] - self.usage[0]
+            res[1] = max(res[1], self.peak)
+            for i in range(2, 6):
+                res[i] += usage[i] - self.usage[i]
+
         # if not an error
         if exit_type is None:
-            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.clock() - self.startcpu) ))
+            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, wall, cpu ))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare the timers saved (with $TIMER_JSON) by two runs')
+    parser.add_argument('json_files', nargs=2, help='Timers of the first (reference) and second run')
+    args = parser.parse_args()
+
+    runs = [json.load(open(json_file))['timers'] for json_file in args.json_files]
+    paths = sorted(set(runs[0]) | set(runs[1]), key=lambda path: path.split('/'))
+    width = max([len(path) for path in paths])
+    print('%-*s %12s %12s %8s' % (width, 'Step', 'wall 1 [s]', 'wall 2 [s]', 'ratio'))
+    for path in paths:
+        walls = [run[path]['wall'] if path in run else float('nan') for run in runs]
+        print('%-*s %12.3f %12.3f %8.2f' % (width, path, walls[0], walls[1], walls[1]/walls[0] if walls[0] > 0 else float('nan')))
@@ -22,6 +22,7 @@
 import os.path, sys, pickle, glob, argparse, re, logging
 import numpy as np
 from lib_fits import flatten, Image
+from lib_timer import profile_script
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.table import Table
@@ -51,6 +52,7 @@ parser.add_argument('--output', dest='output', default='mosaic.fits', help='Name
 
 args = parser.parse_args()
 logging.root.setLevel(logging.DEBUG)
+profile_script(os.path.dirname(os.path.abspath(args.output))) # with $SCRIPTS_PROFILE
 
 #######################################################
 # input check
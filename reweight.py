@@ -23,14 +23,13 @@
 # Author: Francesco de Gasperin
 # Credits: Frits Sweijen, Etienne Bonnassieux
 
-import os, sys, logging, time
+import os, sys, logging, time, contextlib
 import numpy as np
 from casacore.tables import taql, table
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
 
 from lib_timer import Timer
+from lib_multiproc import multiprocPool, WorkerError, worker_cache
+from lib_ms import get_dm_mtime
 
 class MShandler():
     def __init__(self, ms_files, wcolname, dcolname):
@@ -46,32 +45,88 @@ class MShandler():
         self.wcolname = wcolname
         self.dcolname = dcolname
 
-        # if more than one MS, virtualconcat
-        #if len(ms_files) > 1:
-        #    self.ms = taql('select TIME, FLAG, ANTENNA1, ANTENNA2, %s, %s from %s' % ( wcolname, dcolname, ','.join(ms_files) ))
-        #else:
-        #    self.ms = taql('select TIME, FLAG, ANTENNA1, ANTENNA2, %s, %s from %s' % ( wcolname, dcolname, ms_files[0] ))
-        self.ms = table(ms_files[0], readonly=False, ack=False)
+        # multiple MSs are not concatenated, reweight() reads/writes each of them on its own
+        self.ms = table(ms_files[0], ack=False)
 
     def get_antennas(self):
         return taql('select NAME from %s/ANTENNA' % (self.ms_files[0]) ).getcol('NAME')
 
     def get_freqs(self):
-        # TODO: check if there is a smarter way to do it with concat.MS
         freqs = []
         for ms_file in self.ms_files:
-            freqs += list( taql('SELECT CHAN_FREQ FROM %s/SPECTRAL_WINDOW' % ms_file)[0]['CHAN_FREQ'] * 1e-6 ) # in MHz
+            freqs += list( get_ms_freqs(ms_file) ) # in MHz
         return freqs
 
     def get_time(self):
-        # TODO: fix if multiple time MSs passed
-        ms_avgbl = taql('SELECT TIME FROM %s GROUPBY TIME' %(self.ms_files[0]))
-        return ms_avgbl.getcol('TIME')
+        # all timeslots of all MSs
+        times = [taql('SELECT TIME FROM %s GROUPBY TIME' % ms_file).getcol('TIME') for ms_file in self.ms_files]
+        return np.unique(np.concatenate(times))
 
     def get_elev(self):
-        # TODO: fix if multiple time MSs passed
+        # elevation from the first MS, on the timeslots of all MSs
         ms_avgbl = taql('SELECT TIME, MEANS(GAGGR(MSCAL.AZEL1()[1]), 0) AS ELEV FROM %s GROUPBY TIME' %(self.ms_files[0]))
-        return ms_avgbl.getcol('ELEV')
+        times = ms_avgbl.getcol('TIME')
+        order = np.argsort(times)
+        return np.interp(self.get_time(), times[order], ms_avgbl.getcol('ELEV')[order])
+
+    def get_cachefile(self):
+        return os.path.join(self.ms_files[0], 'reweight_stats_%s.npz' % self.dcolname)
+
+    def get_cachekey(self, cols):
+        """
+        Return the paths of the MSs and the modification time of the files that store the columns cols
+        (None for an MS whose columns are stored in other tables, see get_dm_mtime)
+        """
+        paths = []
+        mtimes = []
+        for ms_file in self.ms_files:
+            with table(ms_file, ack=False) as ms:
+                seqnrs = set([ms.getdminfo(col)['SEQNR'] for col in cols])
+            paths.append(os.path.abspath(ms_file))
+            mtimes.append(get_dm_mtime(ms_file, seqnrs))
+        return paths, mtimes
+
+    def load_stats(self, weights=False):
+        """
+        Return the antenna statistics saved by save_stats() as a dict of arrays
+        None if there is no cache or it is not valid for the same MSs (paths) and content (modification time of data column and FLAG)
+        weights: the weight column must also be the one saved with the statistics and not modified since (e.g. to plot it)
+        """
+        cachefile = self.get_cachefile()
+        if not os.path.exists(cachefile): return None
+        paths, mtimes = self.get_cachekey([self.dcolname, 'FLAG'])
+        if None in mtimes: return None
+        try:
+            cached = dict(np.load(cachefile))
+            valid = list(cached.pop('paths')) == paths and list(cached.pop('mtimes')) == mtimes
+            wcolname, wmtimes = str(cached.pop('wcolname')), list(cached.pop('wmtimes'))
+            if valid and weights:
+                valid = wcolname == self.wcolname and wmtimes == self.get_cachekey([self.wcolname])[1]
+            if valid:
+                logging.info('Antenna statistics read from %s.' % cachefile)
+                return cached
+            logging.info('Antenna statistics in %s are outdated.' % cachefile)
+        except Exception as e:
+            logging.warning('Cannot read %s: %s' % (cachefile, e))
+        return None
+
+    def save_stats(self, stats):
+        """
+        Save the antenna statistics (dict of arrays) in the sidecar file ms_files[0]/reweight_stats_<dcolname>.npz
+        The key is the state of the data column and FLAG, and of the weight column (see load_stats())
+        """
+        cachefile = self.get_cachefile()
+        paths, mtimes = self.get_cachekey([self.dcolname, 'FLAG'])
+        wmtimes = self.get_cachekey([self.wcolname])[1]
+        if None in mtimes + wmtimes:
+            logging.info('Antenna statistics not cached (the columns of an MS are stored in other tables).')
+            return
+        try:
+            # write and rename so that a partial file is never read
+            np.savez(cachefile + '.tmp.npz', paths=paths, mtimes=mtimes, wcolname=self.wcolname, wmtimes=wmtimes, **stats)
+            os.replace(cachefile + '.tmp.npz', cachefile)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write %s: %s' % (cachefile, e))
 
     def iter_antenna(self, antennas=None):
         """
@@ -90,102 +145,520 @@ class MShandler():
                     % (self.dcolname, self.wcolname, ant_id, ant_id) )
 
 
-def reweight(MSh, mode):
+def iter_blocks(ms, columns, halo=0, nrows=100000, slices={}):
+    """
+    Iterator over the main table in blocks of whole timeslots (about nrows rows), each column read with a single getcol
+    Each block is read with halo more timeslots on both sides
+    It returns the first and last (excluded) timeslot of the block, the timeslot index of each row and a dict of columns
+    slices: {name: (table, column, blc, trc)} of other tables with the same rows (e.g. other subbands), the slice of the
+    cells of the block rows is returned in the dict of columns as name
+    """
+    times = ms.getcol('TIME')
+    if not np.all(np.diff(times) >= 0):
+        ms = ms.sort('TIME')
+        times = ms.getcol('TIME')
+        # the same TIME gives the same order
+        slices = dict([(name, (t.sort('TIME'), col, blc, trc)) for name, (t, col, blc, trc) in slices.items()])
+    slot_times, slot_rows = np.unique(times, return_index=True)
+    slot_rows = np.append(slot_rows, len(times))
+    nslots = len(slot_times)
+    nslots_block = max(1, int(nrows * nslots / len(times)))
+
+    for s0 in range(0, nslots, nslots_block):
+        s1 = min(s0 + nslots_block, nslots)
+        r0 = slot_rows[max(s0 - halo, 0)]
+        r1 = slot_rows[min(s1 + halo, nslots)]
+        cols = dict([(col, ms.getcol(col, startrow=r0, nrow=r1-r0)) for col in columns])
+        for name, (t, col, blc, trc) in slices.items():
+            cols[name] = t.getcolslice(col, blc, trc, startrow=r0, nrow=r1-r0)
+        yield s0, s1, np.searchsorted(slot_times, times[r0:r1]), cols
+
+
+def get_ms_freqs(ms_file):
+    """
+    Return the channel frequencies of an MS in MHz
+    """
+    return taql('SELECT CHAN_FREQ FROM %s/SPECTRAL_WINDOW' % ms_file)[0]['CHAN_FREQ'] * 1e-6
+
+
+def get_adjacent(ms_files, freqs):
+    """
+    Return the channels of other MSs adjacent on the grid freqs to the first and last channel of each MS
+    (e.g. the last channel of the previous subband) as {ms_file: [(ms_file, chan) or None, (ms_file, chan) or None]}
+    """
+    grid = {} # channel of the grid: (ms_file, chan)
+    ms_chans = {}
+    for ms_file in ms_files:
+        ms_chans[ms_file] = np.searchsorted(freqs, get_ms_freqs(ms_file))
+        for chan, c in enumerate(ms_chans[ms_file]):
+            grid[c] = (ms_file, chan)
+    adjacent = {}
+    for ms_file, chans in ms_chans.items():
+        adjacent[ms_file] = [grid.get(c) for c in (chans[0] - 1, chans[-1] + 1)]
+        adjacent[ms_file] = [adj if adj is not None and adj[0] != ms_file else None for adj in adjacent[ms_file]]
+    return adjacent
+
+
+class AntennaStats():
+    """
+    Running statistics of the unflagged visibilities of each antenna, marginalised over baselines and frequency (per time and pol)
+    and over baselines and time (per freq and pol): number of samples, mean and sum of squared deviations from the mean (M2)
+    Each block of data is reduced on its own and merged with the parallel algorithm of Chan et al.,
+    so the result does not depend on how the MS is split in blocks (or in MSs)
+    """
+    def __init__(self, nant, ntime, nfreq, npol):
+        self.nant, self.ntime, self.nfreq, self.npol = nant, ntime, nfreq, npol
+        self.acc = {'time': [np.zeros((nant*ntime, npol)), np.zeros((nant*ntime, npol), dtype=complex), np.zeros((nant*ntime, npol))],
+                    'freq': [np.zeros((nant*nfreq, npol)), np.zeros((nant*nfreq, npol), dtype=complex), np.zeros((nant*nfreq, npol))]}
+
+    def merge(self, axis, count_b, mean_b, m2_b):
+        """
+        Merge the statistics of a block (count, mean, M2) into the running ones
+        """
+        count, mean, m2 = self.acc[axis]
+        total = count + count_b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.where(total > 0, count_b / total, 0)
+        delta = mean_b - mean
+        mean += delta * frac
+        m2 += m2_b + np.abs(delta)**2 * count * frac
+        count += count_b
+
+    def update(self, other):
+        """
+        Merge the statistics of another AntennaStats (e.g. from another MS) on the same time/freq grid
+        """
+        for axis in ['time', 'freq']:
+            self.merge(axis, *other.acc[axis])
 
-    # get data per antenna
-    var_antenna = {}
-    med_antenna = {}
-    for ant_id, ant_name, ms_ant in MSh.iter_antenna():
+    def add(self, ants, slots, data, valid, chans=None):
+        """
+        Add visibilities (axes: row, freq, pol) at the timeslots slots (one per row), only where valid
+        ants: list of arrays with the antenna of each row, each row is added to all of them (e.g. [ANTENNA1, ANTENNA2])
+        chans: channel of the grid of each data channel, default: all channels in order
+        data is modified in place (non valid samples are set to 0), temporary arrays are of the size of one pol
+        """
+        if chans is None: chans = np.arange(self.nfreq)
+        data[~valid] = 0
+        # per time: reduce rows and channels of each antenna/time - per freq: reduce rows of each antenna/freq
+        for axis, n, index in ( ('time', self.ntime, [a * self.ntime + slots for a in ants]), \
+                ('freq', self.nfreq, [(a[:, np.newaxis] * self.nfreq + chans).ravel() for a in ants]) ):
+            size = self.nant * n
+            count_b = np.zeros((size, self.npol))
+            sum_b = np.zeros((size, self.npol), dtype=complex)
+            for p in range(self.npol):
+                x, v = self._reduce(axis, data[:, :, p], valid[:, :, p])
+                for i in index:
+                    count_b[:, p] += np.bincount(i, weights=v, minlength=size)
+                    sum_b[:, p] += np.bincount(i, weights=x.real, minlength=size) + 1j * np.bincount(i, weights=x.imag, minlength=size)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_b = np.nan_to_num(sum_b / count_b)
+
+            # squared deviations from the block mean
+            m2_b = np.zeros((size, self.npol))
+            for p in range(self.npol):
+                for i in index:
+                    dev = data[:, :, p] - mean_b[:, p].astype(data.dtype)[i].reshape(len(data), -1)
+                    dev = dev.real**2 + dev.imag**2
+                    dev[~valid[:, :, p]] = 0
+                    m2_b[:, p] += np.bincount(i, weights=self._reduce(axis, dev)[0], minlength=size)
+            self.merge(axis, count_b, mean_b, m2_b)
+
+    def _reduce(self, axis, x, v=None):
+        """
+        Sum the channels of each row (time marginal) or flatten rows and channels (freq marginal)
+        """
+        if axis == 'time':
+            return x.sum(axis=1, dtype=np.result_type(x, float)), None if v is None else v.sum(axis=1)
+        return x.ravel(), None if v is None else v.ravel()
 
+    def get(self, axis, pool_pol=False):
+        """
+        Return mean and variance (ddof=0) per antenna along axis ('time' or 'freq'), axes: ant, time (or freq), pol
+        If pool_pol the polarisations are merged (axes: ant, time or freq)
+        """
+        count, mean, m2 = [acc.reshape(self.nant, -1, self.npol) for acc in self.acc[axis]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if pool_pol:
+                total = count.sum(axis=2)
+                mean_pol = (count * mean).sum(axis=2) / total
+                m2 = m2.sum(axis=2) + (count * np.abs(np.nan_to_num(mean - mean_pol[:, :, np.newaxis]))**2).sum(axis=2)
+                return mean_pol, m2 / total
+            return np.where(count > 0, mean, np.nan), m2 / count
+
+    def nsamples(self):
+        """
+        Return the number of unflagged visibilities of each antenna
+        """
+        return self.acc['time'][0].reshape(self.nant, -1).sum(axis=1)
+
+
+def get_neighbours(mean, var):
+    """
+    For each element along the last axis (channel or timeslot) of each antenna return the index of the adjacent element to subtract
+    The adjacent element with the lowest var/mean is used, to avoid propagating bad channels (e.g. with RFI),
+    the first/last elements use the third/one but last
+    """
+    n = mean.shape[-1]
+    idx_l = (np.arange(n) + 1) % n
+    idx_r = (np.arange(n) - 1) % n
+    if n > 2:
+        idx_l[-1] = n - 2
+        idx_r[0] = 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = var / mean
+    ratio[ np.isnan(ratio) ] = np.inf
+    return np.where( ratio[:, idx_l] < ratio[:, idx_r], idx_l, idx_r )
+
+
+def get_weights(marginals, ants1, ants2, slots=None, chans=slice(None)):
+    """
+    Return the weights of the baselines ants1-ants2 from the antenna variances/means along time and freq
+    marginals: (med_t, var_t, med_f, var_f), squared mean amplitudes and variances per antenna (axes: ant,time,pol and ant,freq,pol)
+    If slots is given return the weights of those timeslots (axes: bl,freq,pol), otherwise of all timeslots (axes: bl,time,freq,pol)
+    chans: channels of the grid to use
+    """
+    med_t, var_t, med_f, var_f = marginals
+    if slots is None:
+        # sum of the time/freq means/variances - axes: bl,time,freq,pol
+        get = lambda m_t, m_f, ants: (m_t[ants][..., np.newaxis, :] + m_f[ants][..., np.newaxis, chans, :]).astype(np.float32)
+    else:
+        # axes: bl,freq,pol
+        get = lambda m_t, m_f, ants: (m_t[ants, slots][:, np.newaxis] + m_f[ants][:, chans]).astype(np.float32)
+    var1, var2, med1, med2 = get(var_t, var_f, ants1), get(var_t, var_f, ants2), get(med_t, med_f, ants1), get(med_t, med_f, ants2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1./( var1*med2 + var2*med1 + var1*var2 )
+
+
+def get_median_weights(marginals, bls, good_antenna, nant, nbls):
+    """
+    Return the median of the weights of each baseline (nant x nant, NaN for missing baselines)
+    All baselines of an antenna are computed at once, in groups of nbls baselines
+    """
+    med_bl = np.full((nant, nant), np.nan, dtype=np.float32)
+    for ant_id1 in np.unique(bls // nant):
+        if not good_antenna[ant_id1]: continue
+        bls_ant2 = bls[ (bls // nant == ant_id1) & good_antenna[bls % nant] ] % nant
+        for i in range(0, len(bls_ant2), nbls):
+            ant_id2 = bls_ant2[i:i+nbls]
+            w = get_weights(marginals, ant_id1, ant_id2)
+            med_bl[ant_id1, ant_id2] = np.nanmedian(w.reshape(len(ant_id2), -1), axis=1) # TEST: REMOVE MEDIAN?
+    return med_bl
+
+
+def get_stats(ms_file, dcolname, nant, times, freqs, mode=None, choice=None, nrows=100000, adjacent=None):
+    """
+    Accumulate the statistics of each antenna of an MS on the time/freq grid of all MSs
+    Each visibility of a baseline counts for both its antennas
+    mode/choice: for 'subchan'/'subtime' the statistics are of the differences with the adjacent channels/timeslots,
+    chosen from choice = (mean, var) per antenna along the grid freqs/times (polarisations merged)
+    adjacent: for 'subchan' the channels of the other MSs next to the first/last channel of each MS (see get_adjacent),
+    the edge channels are then differenced with them as in the concatenated MSs (if the MSs have the same rows).
+    Without them, and for 'subtime', the differences are taken within the MS
+    Return the AntennaStats and the baselines of the MS (as ANTENNA1*nant+ANTENNA2)
+    The MSs stay open in the process (worker_cache) for the next passes, they are only unlocked
+    """
+    ms = worker_cache(('ms', ms_file), lambda: table(ms_file, ack=False))
+    slot_map = np.searchsorted(times, np.unique(ms.getcol('TIME'))) # timeslot of the grid of each timeslot of the MS
+    chans = np.searchsorted(freqs, get_ms_freqs(ms_file)) # channel of the grid of each channel of the MS
+    nfreq, npol = ms.getcell('FLAG', 0).shape
+    ntime = len(slot_map)
+    bls = np.unique(ms.getcol('ANTENNA1') * nant + ms.getcol('ANTENNA2'))
+    stats = AntennaStats(nant, len(times), len(freqs), npol)
+
+    if mode is None or mode == 'residual':
+        for s0, s1, slots, cols in iter_blocks(ms, ['ANTENNA1', 'ANTENNA2', 'FLAG', dcolname], nrows=nrows):
+            data = cols[dcolname]
+            valid = ~cols['FLAG'] & ~np.isnan(data)
+            valid &= (cols['ANTENNA1'] != cols['ANTENNA2'])[:, np.newaxis, np.newaxis]
+            stats.add([cols['ANTENNA1'], cols['ANTENNA2']], slot_map[slots], data, valid, chans)
+        ms.unlock()
+        return stats, bls
+
+    # data column is updated subtracting adjacent channels (or times) of the MS
+    slices = {}
+    edges = []
+    if mode == 'subchan':
+        # ant x freq: subtract the previous channel (of the grid) or the next one
+        prev_chan = get_neighbours(choice[0], choice[1])[:, chans] <= chans
+        for edge, adj in zip(['prev', 'next'], adjacent[ms_file] if adjacent is not None else [None, None]):
+            if adj is None: continue
+            adj_ms = worker_cache(('ms', adj[0]), lambda: table(adj[0], ack=False))
+            if adj_ms.nrows() == ms.nrows() and all([np.array_equal(adj_ms.getcol(col), ms.getcol(col)) for col in ['TIME', 'ANTENNA1', 'ANTENNA2']]):
+                edges.append(edge)
+                slices[edge+'_data'] = (adj_ms, dcolname, [adj[1], 0], [adj[1], npol-1])
+                slices[edge+'_flag'] = (adj_ms, 'FLAG', [adj[1], 0], [adj[1], npol-1])
+            else:
+                logging.warning('%s and %s have different rows, their edge channels are differenced within each MS.' % (ms_file, adj[0]))
+        # without an adjacent MS the edge channels use the only neighbour in the MS
+        if 'prev' not in edges and nfreq > 1: prev_chan[:, 0] = False
+        if 'next' not in edges: prev_chan[:, -1] = True
+    else:
+        neighbours = get_neighbours(choice[0][:, slot_map], choice[1][:, slot_map]) # ant x time: timeslot to subtract
+
+    # the block is replaced in place by the differences with the previous channel (timeslot), then the difference
+    # with the chosen neighbour is either that one (previous) or minus the one of the next channel (timeslot)
+    for s0, s1, slots, cols in iter_blocks(ms, ['ANTENNA1', 'ANTENNA2', 'FLAG', dcolname], halo=(mode == 'subtime'), nrows=nrows, slices=slices):
+        ants1, ants2 = cols['ANTENNA1'], cols['ANTENNA2']
+        data = cols[dcolname]
+        valid = ~cols['FLAG'] & ~np.isnan(data)
+        interior = ((ants1 != ants2) & (slots >= s0) & (slots < s1))[:, np.newaxis, np.newaxis]
+
+        if mode == 'subchan':
+            # the last channel minus the first one of the next MS
+            if 'next' in edges:
+                last = data[:, -1] - cols['next_data'][:, 0]
+                valid_last = valid[:, -1] & ~cols['next_flag'][:, 0] & ~np.isnan(last)
+            for c in range(nfreq-1, 0, -1):
+                data[:, c] -= data[:, c-1]
+                valid[:, c] &= valid[:, c-1]
+            # the first channel minus the last one of the previous MS
+            if 'prev' in edges:
+                data[:, 0] -= cols['prev_data'][:, 0]
+                valid[:, 0] &= ~cols['prev_flag'][:, 0] & ~np.isnan(data[:, 0])
+            elif nfreq == 1 and 'next' not in edges:
+                data[:] = 0 # a channel subtracted from itself
+            for ants in (ants1, ants2):
+                prev = prev_chan[ants][:, :, np.newaxis]
+                diff = np.empty_like(data)
+                diff[:, -1] = last if 'next' in edges else data[:, -1]
+                np.negative(data[:, 1:], out=diff[:, :-1])
+                np.copyto(diff, data, where=prev)
+                valid_diff = np.empty_like(valid)
+                valid_diff[:, -1] = valid_last if 'next' in edges else valid[:, -1]
+                valid_diff[:, :-1] = valid[:, 1:]
+                np.copyto(valid_diff, valid, where=prev)
+                valid_diff &= interior
+                stats.add([ants], slot_map[slots], diff, valid_diff, chans)
+
+        else:
+            # row of each baseline/timeslot of the block
+            slot0 = np.min(slots)
+            rows = np.full((nant * nant, np.max(slots) - slot0 + 1), -1)
+            rows[ants1 * nant + ants2, slots - slot0] = np.arange(len(slots))
+            for t in range(rows.shape[1]-1, 0, -1):
+                row, row_prev = rows[:, t], rows[:, t-1]
+                valid[ row[(row >= 0) & (row_prev < 0)] ] = False
+                row, row_prev = row[(row >= 0) & (row_prev >= 0)], row_prev[(row >= 0) & (row_prev >= 0)]
+                data[row] -= data[row_prev]
+                valid[row] &= valid[row_prev]
+            if ntime == 1: data[:] = 0 # a timeslot subtracted from itself
+            row_next = rows[ants1 * nant + ants2, np.minimum(slots - slot0 + 1, rows.shape[1] - 1)]
+            for ants in (ants1, ants2):
+                prev = (neighbours[ants, slots] <= slots)[:, np.newaxis, np.newaxis]
+                diff = data[row_next]
+                np.negative(diff, out=diff)
+                np.copyto(diff, data, where=prev)
+                valid_diff = valid[row_next]
+                valid_diff &= (row_next >= 0)[:, np.newaxis, np.newaxis]
+                np.copyto(valid_diff, valid, where=prev)
+                valid_diff &= interior
+                stats.add([ants], slot_map[slots], diff, valid_diff, chans)
+
+    for t, col, blc, trc in slices.values():
+        t.unlock()
+    ms.unlock()
+    return stats, bls
+
+
+def write_weights(ms_file, wcolname, marginals, med_bl, good_antenna, times, freqs, nrows=100000):
+    """
+    Reconstruct the BL weights of an MS from the antenna statistics and flag weights that are nans
+    Return the number of new flags
+    """
+    ms = table(ms_file, readonly=False, ack=False)
+    chans = np.searchsorted(freqs, get_ms_freqs(ms_file))
+    ntoflag = 0
+    nvis = 0
+    for startrow in range(0, ms.nrows(), nrows):
+        a1 = ms.getcol('ANTENNA1', startrow, nrows)
+        a2 = ms.getcol('ANTENNA2', startrow, nrows)
+        slots = np.searchsorted(times, ms.getcol('TIME', startrow, nrows))
+        good = good_antenna[a1] & good_antenna[a2]
+        weights = ms.getcol(wcolname, startrow, nrows)
+        flags = ms.getcol('FLAG', startrow, nrows)
+
+        w = get_weights(marginals, a1[good], a2[good], slots[good], chans)
+        w -= med_bl[a1[good], a2[good]][:, np.newaxis, np.newaxis]
+        nans = np.isnan(w)
+        # find how many unflagged weights are nans
+        ntoflag += np.count_nonzero(nans & ~flags[good])
+        nvis += flags.size
+        w[nans] = 0
+        weights[good] = w
+        flags[good] |= nans
+
+        ms.putcol(wcolname, weights, startrow, len(a1))
+        ms.putcol('FLAG', flags, startrow, len(a1))
+    logging.debug( '%s: created %i new flags (%f%%)' % ( ms_file, ntoflag, (100.*ntoflag)/nvis ) )
+    ms.close()
+    return ntoflag
+
+
+def stats_worker(ms_file, *args, outQueue=None):
+    """
+    get_stats() in a worker process, an error is raised in the parent process (WorkerError)
+    """
+    outQueue.put([ms_file, get_stats(ms_file, *args)])
+
+
+def write_worker(ms_file, *args, outQueue=None):
+    """
+    write_weights() in a worker process, an error is raised in the parent process (WorkerError)
+    """
+    outQueue.put([ms_file, write_weights(ms_file, *args)])
+
+
+def run_ms(MSh, funct, worker, args, pool=None):
+    """
+    Run funct(ms_file, *args) for all MSs of the MShandler, in the worker processes of pool if given (and there are more MSs)
+    Return the results in the order of the MSs, exit if any MS failed
+    """
+    # the MSs are opened again by funct, do not keep them waiting for the lock of MSh.ms (any read of it takes it again)
+    MSh.ms.unlock()
+    ms_files = MSh.ms_files
+    if pool is None or len(ms_files) == 1:
+        return [funct(ms_file, *args) for ms_file in ms_files]
+
+    for ms_file in ms_files:
+        pool.submit(worker, [ms_file] + list(args))
+    # a failed MS raises WorkerError (with the traceback of the worker), the other MSs go on
+    results = {}
+    failed = False
+    while True:
+        try:
+            for ms_file, result in pool.get():
+                results[ms_file] = result
+            break
+        except WorkerError as e:
+            logging.error(e)
+            failed = True
+    if failed:
+        logging.error('Failed MSs: %s' % ','.join([ms_file for ms_file in ms_files if ms_file not in results]))
+        sys.exit(1)
+    return [results[ms_file] for ms_file in ms_files]
+
+
+@Timer('reweight')
+def reweight(MSh, mode, nrows=100000, pool=None, cache=True):
+    """
+    Compute the weights from the antenna statistics of all MSs and write them in each MS
+    The MSs (e.g. the subbands of an observation) are read/written by the processes of pool, their statistics are merged
+    nrows: number of rows read at once, it sets the memory usage (per process)
+    cache: reuse/save the antenna statistics in the sidecar file of MShandler.save_stats(), so that the weights can be
+    applied again (or plotted) without reading the data. The cache is saved after the weights are written, keyed on the
+    new flags: a rerun deliberately applies the same statistics again, while a run without cache recomputes them
+    excluding the samples flagged by the first run
+    """
+
+    nant = len(MSh.get_antennas())
+    cached = MSh.load_stats() if cache else None
+
+    def merge(results):
+        stats = results[0][0]
+        for other, bls in results[1:]:
+            stats.update(other)
+        return stats, np.unique(np.concatenate([bls for other, bls in results]))
+
+    if cached is not None and cached['mode'] == mode:
+        times, freqs, bls, good_antenna = cached['times'], cached['freqs'], cached['bls'], cached['good_antenna']
+        marginals = (cached['med_t'], cached['var_t'], cached['med_f'], cached['var_f'])
+
+    else:
+        times = MSh.get_time()
+        freqs = np.unique(MSh.get_freqs())
+
+        # accumulate the statistics of each antenna with a single pass on the MSs
         with Timer('Get data'):
-            data = ms_ant.getcol('GDATA') # axes: time, ant, freq, pol
-            flags = ms_ant.getcol('GFLAG') # axes: time, ant, freq, pol
-
-            # put flagged data to NaNs
-            data[flags] = np.nan
-
-            # if completely flagged set variance to 1 and continue
-            if np.all(flags):
-                var_antenna[ant_id] = None
-                med_antenna[ant_id] = None
-                continue
-
-        with Timer('Prepare data'):
-
-            # data column is updated subtracting adjacent channels
-            if mode == 'subchan':
-                data_shifted_l = np.roll(data, -1, axis=2)
-                data_shifted_r = np.roll(data, +1, axis=2)
-                # if only 2 freq it's aleady ok, subtracting one from the other
-                if data.shape[2] > 2:
-                    data_shifted_l[:,:,-1,:] = data_shifted_l[:,:,-3,:] # last chan uses the one but last
-                    data_shifted_r[:,:,0,:] = data_shifted_r[:,:,2,:] # first chan uses third
-                # get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-                ratio_l = np.nanvar(data_shifted_l, axis=(0,1,3))/np.nanmean(data_shifted_l, axis=(0,1,3))
-                ratio_l[ np.isnan(ratio_l) ] = np.inf
-                ratio_r = np.nanvar(data_shifted_r, axis=(0,1,3))/np.nanmean(data_shifted_r, axis=(0,1,3))
-                ratio_r[ np.isnan(ratio_r) ] = np.inf
-                data = np.where( ( ratio_l < ratio_r )[np.newaxis,np.newaxis,:,np.newaxis], data - data_shifted_l, data - data_shifted_r)
-
-            # data column is updated subtracting adjacent times
-            if mode == 'subtime':
-                data_shifted_l = np.roll(data, -1, axis=0)
-                data_shifted_r = np.roll(data, +1, axis=0)
-                # if only 2 freq it's aleady ok, subtracting one from the other
-                if data.shape[0] > 2:
-                    data_shifted_l[-1,:,:,:] = data_shifted_l[-3,:,:,:] # last timeslot uses the one but last
-                    data_shifted_r[0,:,:,:] = data_shifted_r[2,:,:,:] # first timeslot uses third
-                # get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-                ratio_l = np.nanvar(data_shifted_l, axis=(1,2,3))/np.nanmean(data_shifted_l, axis=(1,2,3))
-                ratio_l[ np.isnan(ratio_l) ] = np.inf
-                ratio_r = np.nanvar(data_shifted_r, axis=(1,2,3))/np.nanmean(data_shifted_r, axis=(1,2,3))
-                ratio_r[ np.isnan(ratio_r) ] = np.inf
-                data = np.where( ( ratio_l < ratio_r )[:,np.newaxis,np.newaxis,np.newaxis], data - data_shifted_l, data - data_shifted_r)
-
-            # use residual data, nothing to do here
-            elif mode == 'residual':
-                pass
-
-        with Timer('Calc variances'):
-            # find mean/variance per time/freq for each antenna
-
-            med_freqs = np.abs( np.nanmean( data, axis=(1,2) )**2 ) # time x pol
-            med_times = np.abs( np.nanmean( data, axis=(0,1) )**2 ) # freq x pol
-            med_antenna[ant_id] = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
-
-            var_freqs = np.nanvar( data, axis=(1,2) ) # time x pol
-            var_times = np.nanvar( data, axis=(0,1) ) # freq x pol
-            var_antenna[ant_id] = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
-
-    # reconstruct BL weights from antenna variance
-    for ms_bl in MSh.ms.iter(["ANTENNA1","ANTENNA2"]):
-        ant_id1 = ms_bl.getcol('ANTENNA1')[0]
-        ant_id2 = ms_bl.getcol('ANTENNA2')[0]
+            stats, bls = merge(run_ms(MSh, get_stats, stats_worker, [MSh.dcolname, nant, times, freqs, None, None, nrows], pool))
+            nsamples = stats.nsamples()
 
-        if var_antenna[ant_id1] is None or var_antenna[ant_id2] is None: continue
+        # data column is updated subtracting adjacent channels (or times), the statistics are computed again on the differences
+        if mode == 'subchan' or mode == 'subtime':
+            with Timer('Prepare data'):
+                choice = stats.get('freq' if mode == 'subchan' else 'time', pool_pol=True)
+                # the edge channels of each subband are differenced with the adjacent subbands, as in the concatenated MSs
+                adjacent = get_adjacent(MSh.ms_files, freqs) if mode == 'subchan' else None
+                stats, bls = merge(run_ms(MSh, get_stats, stats_worker, [MSh.dcolname, nant, times, freqs, mode, choice, nrows, adjacent], pool))
 
-#        print '### BL: %i - %i' % (ant_id1, ant_id2)
-#        print var_antenna[ant_id1]*med_antenna[ant_id2]
-#        print ''
-#        print var_antenna[ant_id2]*med_antenna[ant_id1]
-#        print ''
-#        print var_antenna[ant_id1]*var_antenna[ant_id2]
-        w = 1./( var_antenna[ant_id1]*med_antenna[ant_id2] + var_antenna[ant_id2]*med_antenna[ant_id1] \
-               + var_antenna[ant_id1]*var_antenna[ant_id2] )
-
-        w -= np.nanmedian(w) # TEST: REMOVE MEDIAN?
-
-        f = ms_bl.getcol('FLAG')
-        # find how many unflagged weights are nans
-        ntoflag = np.count_nonzero(np.isnan(w[~f]))
-        logging.debug( 'BL: %i - %i: created %i new flags (%f%%)' % ( ant_id1, ant_id2, ntoflag, (100.*ntoflag)/np.size(w) ) )
-        ms_bl.putcol(MSh.wcolname, w)
-        ms_bl.flush()
-        # flag weights that are nans
-        taql('update $ms_bl set FLAG[isnan(WEIGHT_SPECTRUM)]=True, WEIGHT_SPECTRUM[isnan(WEIGHT_SPECTRUM)]=0')
-        ms_bl.flush()
+        # use residual data, nothing to do here
+        elif mode == 'residual':
+            pass
 
-def plot(MSh, antennas):
+        with Timer('Calc variances'):
+            # find mean/variance per time/freq for each antenna
+            mean_t, var_t = stats.get('time') # ant x time x pol
+            mean_f, var_f = stats.get('freq') # ant x freq x pol
+            marginals = (np.abs(mean_t)**2, var_t, np.abs(mean_f)**2, var_f)
+            # if completely flagged the weights are not changed
+            good_antenna = nsamples > 0
+
+        # var_antenna/med_antenna (axes: ant,time,freq,pol) are the sums of these time and freq marginals
+        cached = {'mode': mode, 'antennas': MSh.get_antennas(), 'times': times, 'freqs': freqs, 'bls': bls, 'good_antenna': good_antenna, \
+                  'med_t': marginals[0], 'var_t': marginals[1], 'med_f': marginals[2], 'var_f': marginals[3]}
+
+    with Timer('Write weights'):
+        # median of the weights of each baseline (over all MSs), in groups of baselines not to exceed the size of a read block
+        med_bl = get_median_weights(marginals, bls, good_antenna, nant, max(1, int(nrows / len(times) / len(MSh.ms_files))))
+        run_ms(MSh, write_weights, write_worker, [MSh.wcolname, marginals, med_bl, good_antenna, times, freqs, nrows], pool)
+
+    # keyed on the new flags and weights, to reapply the same statistics and to plot the weights just written
+    if cache: MSh.save_stats(cached)
+
+
+def iter_ms_weights(MSh, antennas):
+    """
+    Iterator over the weights of each antenna read from the MS, mean over the baselines of the antenna (axes: time,freq,pol)
+    It returns antenna id, antenna name, weights and flags (all baselines flagged)
+    """
+    for ant_id, ant_name, ms_ant in MSh.iter_antenna(antennas):
+        w = np.abs(ms_ant.getcol('GWEIGHT')) # time,bl,freq,pol
+        flag = ms_ant.getcol('GFLAG') # time,bl,freq,pol
+        w[flag] = np.nan
+        w = np.nanmean(w, axis=1)
+        flag = np.all(flag, axis=1)
+        yield ant_id, ant_name, w, flag
+
+
+def iter_cached_weights(MSh, cached, antennas, nrows=100000):
+    """
+    Iterator over the weights of each antenna reconstructed from the cached antenna statistics (see reweight()),
+    mean over the unflagged baselines of the antenna (axes: time,freq,pol) as in iter_ms_weights()
+    Only FLAG is read from the MSs (in blocks of nrows rows), the weights are those written by reweight() if the cache
+    is valid for the weight column (MShandler.load_stats(weights=True))
+    It returns antenna id, antenna name, weights and flags (all baselines flagged)
+    """
+    nant = len(cached['antennas'])
+    times, freqs = cached['times'], cached['freqs']
+    marginals = (cached['med_t'], cached['var_t'], cached['med_f'], cached['var_f'])
+    med_bl = get_median_weights(marginals, cached['bls'], cached['good_antenna'], nant, max(1, int(nrows / len(times))))
+
+    for ant_id, ant_name in enumerate(cached['antennas']):
+        if antennas is not None and ant_name not in antennas: continue
+        logging.info('Workign on antenna: %s', ant_name)
+        w_sum = np.zeros((len(times), len(freqs), cached['var_t'].shape[-1]))
+        w_count = np.zeros_like(w_sum)
+        for ms_file in MSh.ms_files:
+            chans = np.searchsorted(freqs, get_ms_freqs(ms_file))
+            ms_ant = taql('select TIME, ANTENNA1, ANTENNA2, FLAG from %s where (ANTENNA1=%i or ANTENNA2=%i) and (ANTENNA1 != ANTENNA2)' \
+                    % (ms_file, ant_id, ant_id))
+            for startrow in range(0, ms_ant.nrows(), nrows):
+                a1 = ms_ant.getcol('ANTENNA1', startrow, nrows)
+                a2 = ms_ant.getcol('ANTENNA2', startrow, nrows)
+                slots = np.searchsorted(times, ms_ant.getcol('TIME', startrow, nrows))
+                w = get_weights(marginals, a1, a2, slots, chans)
+                w -= med_bl[a1, a2][:, np.newaxis, np.newaxis]
+                valid = ~ms_ant.getcol('FLAG', startrow, nrows) & ~np.isnan(w)
+                np.add.at(w_sum, (slots[:, np.newaxis], chans), np.where(valid, np.abs(w), 0))
+                np.add.at(w_count, (slots[:, np.newaxis], chans), valid)
+            ms_ant.close()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = w_sum / w_count
+        yield ant_id, ant_name, w, w_count == 0
+
+
+@Timer('plot')
+def plot(MSh, antennas, cache=True, pool=None):
 
     if antennas is not None:
         for antenna in antennas:
@@ -193,184 +666,233 @@ def plot(MSh, antennas):
                 logging.error('Missing antenna %s' % antenna)
                 sys.exit(1)
 
-    logging.info('Getting time/freq aggregated values...')
-    freqs = MSh.get_freqs()
-    elev = MSh.get_elev()
-    time = MSh.get_time()
-    time -= time[0]
+    # plot the weights from the antenna statistics of the last reweight() if the weight column was not changed since,
+    # otherwise read them from the MS
+    cached = MSh.load_stats(weights=True) if cache else None
+    if cached is None:
+        if len(MSh.ms_files) > 1:
+            logging.error('Plotting more than 1 MS without the statistics of a previous reweighting (of the same weight column) not implemented.')
+            sys.exit(1)
+        logging.info('Getting time/freq aggregated values...')
+        freqs = MSh.get_freqs()
+        elev = MSh.get_elev()
+        time = MSh.get_time()
+        weights = iter_ms_weights(MSh, antennas)
+    else:
+        freqs = cached['freqs']
+        time = cached['times']
+        if 'elev' not in cached:
+            cached['elev'] = MSh.get_elev()
+            MSh.save_stats(cached)
+        elev = cached['elev']
+        weights = iter_cached_weights(MSh, cached, antennas)
+
+    time = time - time[0]
     time /= 3600. # in h from the beginning of the obs
 
-    fig = plt.figure(figsize=(15,15))
-
-    for ant_id, ant_name, ms_ant in MSh.iter_antenna(antennas):
-        
-        fig.suptitle(ant_name, fontweight='bold')
-        fig.subplots_adjust(wspace=0)
-        axt = plt.subplot2grid((4, 2), (0, 0), colspan=2)
-        axf = plt.subplot2grid((4, 2), (1, 0), colspan=2)
-        ax1 = plt.subplot2grid((4, 2), (2, 0))
-        ax2 = plt.subplot2grid((4, 2), (2, 1))
-        ax3 = plt.subplot2grid((4, 2), (3, 0))
-        ax4 = plt.subplot2grid((4, 2), (3, 1))
-        # TEST
-        #axtv = plt.subplot2grid((6, 2), (4, 0), colspan=2)
-        #axfv = plt.subplot2grid((6, 2), (5, 0), colspan=2)
-        ###
-
-        w = np.abs(ms_ant.getcol('GWEIGHT')) # time,freq,pol
-        flag = ms_ant.getcol('GFLAG') # time,freq,pol
-        w[flag] = np.nan
-        w = np.nanmean(w, axis=1)
-        flag = np.all(flag, axis=1)
-
-        ### TEST
-        ## subchan
-        #w = np.abs(w)
-        #data_shifted_l = np.roll(w, -1, axis=1)
-        #data_shifted_r = np.roll(w, +1, axis=1)
-        ## if only 2 times it's aleady ok, subtracting one from the other
-        #if w.shape[0] > 2:
-        #    data_shifted_l[:,-1,:] = data_shifted_l[:,-3,:] # last timeslot uses the one but last
-        #    data_shifted_r[:,0,:] = data_shifted_r[:,2,:] # first timeslot uses third
-        ## get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-        #ratio_l = np.nanvar(data_shifted_l, axis=(0,2))/np.nanmean(data_shifted_l, axis=(0,2))
-        #ratio_l[ np.isnan(ratio_l) ] = np.inf
-        #ratio_r = np.nanvar(data_shifted_r, axis=(0,2))/np.nanmean(data_shifted_r, axis=(0,2))
-        #ratio_r[ np.isnan(ratio_r) ] = np.inf
-        #w = np.where( ( ratio_l < ratio_r )[np.newaxis,:,np.newaxis], w - data_shifted_l, w - data_shifted_r)
-        ####
-        #### TEST
-        ## subtime
-        #w = np.abs(w)
-        #data_shifted_l = np.roll(w, -1, axis=0)
-        #data_shifted_r = np.roll(w, +1, axis=0)
-        ## if only 2 times it's aleady ok, subtracting one from the other
-        #if w.shape[1] > 2:
-        #    data_shifted_l[-1,:,:] = data_shifted_l[-3,:,:] # last timeslot uses the one but last
-        #    data_shifted_r[0,:,:] = data_shifted_r[2,:,:] # first timeslot uses third
-        ## get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-        #ratio_l = np.nanvar(data_shifted_l, axis=(1,2))/np.nanmean(data_shifted_l, axis=(1,2))
-        #ratio_l[ np.isnan(ratio_l) ] = np.inf
-        #ratio_r = np.nanvar(data_shifted_r, axis=(1,2))/np.nanmean(data_shifted_r, axis=(1,2))
-        #ratio_r[ np.isnan(ratio_r) ] = np.inf
-        #print 'subtime'
-        #print ( ratio_l < ratio_r )[np.newaxis,:,np.newaxis]
-        #print 'subtime'
-        #print w - data_shifted_l
-        #w = np.where( ( ratio_l < ratio_r )[:,np.newaxis,np.newaxis], w - data_shifted_l, w - data_shifted_r)
-        ####
-
-        ### TEST           
-        #med_freqs = np.abs( np.nanmean( w, axis=(1) )**2 ) # time x pol
-        #med_times = np.abs( np.nanmean( w, axis=(0) )**2 ) # freq x pol
-        #med_antenna = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
-        #var_freqs = np.nanvar( w, axis=(1) ) # time x pol
-        #var_times = np.nanvar( w, axis=(0) ) # freq x pol
-        #var_antenna = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
-        #var_antenna = 1/(var_antenna*med_antenna)
-        ###
-
-
+    submitted = []
+    for ant_id, ant_name, w, flag in weights:
         # skip if completely flagged
         if np.all(flag):
             continue
+        if pool is not None:
+            pool.submit(plot_worker, [ant_name, w, time, freqs, elev])
+            submitted.append(ant_name)
+        else:
+            plot_antenna(ant_name, w, time, freqs, elev)
+
+    if pool is not None:
+        # a failed plot raises WorkerError (with the traceback of the worker), the other plots go on
+        done = []
+        while True:
+            try:
+                for ant_name in pool.get():
+                    done.append(ant_name)
+                break
+            except WorkerError as e:
+                logging.error(e)
+        if len(done) < len(submitted):
+            logging.error('Failed plots: %s' % ','.join([ant_name for ant_name in submitted if ant_name not in done]))
+            sys.exit(1)
+
+
+def plot_worker(ant_name, w, time, freqs, elev, outQueue=None):
+    """
+    plot_antenna() in a worker process, an error is raised in the parent process (WorkerError)
+    """
+    plot_antenna(ant_name, w, time, freqs, elev)
+    outQueue.put(ant_name)
+
+
+def plot_antenna(ant_name, w, time, freqs, elev):
+    """
+    Plot the weights of an antenna (axes: time,freq,pol) in <ant_name>.png
+    time in h, freqs in MHz, elev in rad
+    """
+    # matplotlib is imported only when plotting, each process draws on its own figure
+    import matplotlib as mpl
+    mpl.use("Agg")
+    import matplotlib.pyplot as plt
+
+    logging.info('Plotting %s...' % ant_name)
+    fig = plt.figure(figsize=(15,15))
 
-        logging.info('Plotting %s...' % ant_name)
-
-        w_f = np.nanmedian(w, axis=0) # average in time
-        w_t = np.nanmedian(w, axis=1) # average in freq
-
-        # 3D plot
-        bbox = ax1.get_window_extent().transformed(fig.dpi_scale_trans.inverted())
-        aspect = (time[-1]-time[0])*bbox.height/((freqs[-1]-freqs[0])*bbox.width)
-
-        im = ax1.imshow(w[...,0].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-                        extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        im = ax2.imshow(w[...,1].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-                        extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        im = ax3.imshow(w[...,2].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-                        extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        im = ax4.imshow(w[...,3].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-                        extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-
-        ### TEST
-        #im = ax1.imshow(var_antenna[...,0].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-        #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        #im = ax2.imshow(var_antenna[...,1].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-        #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        #im = ax3.imshow(var_antenna[...,2].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-        #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        #im = ax4.imshow(var_antenna[...,3].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
-        #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
-        ###
-
-        ax2.tick_params(labelleft='off')
-        ax4.tick_params(labelleft='off')
-        ax3.set_xlabel('Time [h]')
-        ax4.set_xlabel('Time [h]')
-        ax1.set_ylabel('Frequency [MHz]')
-        ax3.set_ylabel('Frequency [MHz]')
-
-        # Elevation
-        ax_elev = axt.twinx()
-        ax_elev.plot(time, elev * 180/np.pi, 'k', linestyle=':', linewidth=1, label='Elevation')
-        ax_elev.set_ylabel('Elevation [deg]')
-
-        axt.scatter(time, w_t[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
-        axt.scatter(time, w_t[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
-        axt.scatter(time, w_t[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
-        axt.scatter(time, w_t[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
-        axt.set_xlim(np.min(time), np.max(time))
-        axt.set_ylim(np.nanmin(w_t), np.nanmax(w_t))
-        axt.set_xlabel('Time [h]')
-
-        axf.scatter(freqs, w_f[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
-        axf.scatter(freqs, w_f[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
-        axf.scatter(freqs, w_f[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
-        axf.scatter(freqs, w_f[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
-        axf.set_xlim(np.min(freqs), np.max(freqs))
-        axf.set_ylim(np.nanmin(w_f), np.nanmax(w_f))
-        axf.set_xlabel('Frequency [MHz]')
-
-        handles, labels = axt.get_legend_handles_labels()
-        handles2, labels2 = ax_elev.get_legend_handles_labels()
-        leg = axt.legend(handles+handles2, labels+labels2, loc='upper center', bbox_to_anchor=(0.5, 1.2), ncol=5, borderaxespad=0.0)
-
-        ###
-        # TEST on residuals
-        #med_freqs = np.abs( np.nanmean( w, axis=(1,2) )**2 ) # time x pol
-        #med_times = np.abs( np.nanmean( w, axis=(0,1) )**2 ) # freq x pol
-        #med_antenna[ant_id] = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
-
-        #var_freqs = np.nanvar( w, axis=(1,2) ) # time x pol
-        #var_times = np.nanvar( w, axis=(0,1) ) # freq x pol
-        #var_antenna[ant_id] = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
-
-        #w_f = np.nanvar(w, axis=0) # variance in time
-        #w_t = np.nanvar(w, axis=1) # variance in freq
-        #axtv.scatter(time, w_t[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
-        #axtv.scatter(time, w_t[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
-        #axtv.scatter(time, w_t[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
-        #axtv.scatter(time, w_t[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
-        #axtv.set_xlim(np.min(time), np.max(time))
-        #axtv.set_ylim(np.nanmin(w_t), np.nanmax(w_t))
-        #axtv.set_xlabel('Time [h]')
-        #axtv.set_yscale("log")
-
-        #axfv.scatter(freqs, w_f[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
-        #axfv.scatter(freqs, w_f[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
-        #axfv.scatter(freqs, w_f[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
-        #axfv.scatter(freqs, w_f[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
-        #axfv.set_xlim(np.min(freqs), np.max(freqs))
-        #axfv.set_ylim(np.nanmin(w_f), np.nanmax(w_f))
-        #axfv.set_xlabel('Frequency [MHz]')
-        #axfv.set_yscale("log")
-        ####
-
-        imagename = ant_name+'.png'
-        logging.info('Save file: %s' % (imagename))
-        fig.savefig(imagename, bbox_inches='tight', additional_artists=leg, dpi=250)
-        fig.clf()
+    fig.suptitle(ant_name, fontweight='bold')
+    fig.subplots_adjust(wspace=0)
+    axt = plt.subplot2grid((4, 2), (0, 0), colspan=2)
+    axf = plt.subplot2grid((4, 2), (1, 0), colspan=2)
+    ax1 = plt.subplot2grid((4, 2), (2, 0))
+    ax2 = plt.subplot2grid((4, 2), (2, 1))
+    ax3 = plt.subplot2grid((4, 2), (3, 0))
+    ax4 = plt.subplot2grid((4, 2), (3, 1))
+    # TEST
+    #axtv = plt.subplot2grid((6, 2), (4, 0), colspan=2)
+    #axfv = plt.subplot2grid((6, 2), (5, 0), colspan=2)
+    ###
+
+    ### TEST
+    ## subchan
+    #w = np.abs(w)
+    #data_shifted_l = np.roll(w, -1, axis=1)
+    #data_shifted_r = np.roll(w, +1, axis=1)
+    ## if only 2 times it's aleady ok, subtracting one from the other
+    #if w.shape[0] > 2:
+    #    data_shifted_l[:,-1,:] = data_shifted_l[:,-3,:] # last timeslot uses the one but last
+    #    data_shifted_r[:,0,:] = data_shifted_r[:,2,:] # first timeslot uses third
+    ## get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
+    #ratio_l = np.nanvar(data_shifted_l, axis=(0,2))/np.nanmean(data_shifted_l, axis=(0,2))
+    #ratio_l[ np.isnan(ratio_l) ] = np.inf
+    #ratio_r = np.nanvar(data_shifted_r, axis=(0,2))/np.nanmean(data_shifted_r, axis=(0,2))
+    #ratio_r[ np.isnan(ratio_r) ] = np.inf
+    #w = np.where( ( ratio_l < ratio_r )[np.newaxis,:,np.newaxis], w - data_shifted_l, w - data_shifted_r)
+    ####
+    #### TEST
+    ## subtime
+    #w = np.abs(w)
+    #data_shifted_l = np.roll(w, -1, axis=0)
+    #data_shifted_r = np.roll(w, +1, axis=0)
+    ## if only 2 times it's aleady ok, subtracting one from the other
+    #if w.shape[1] > 2:
+    #    data_shifted_l[-1,:,:] = data_shifted_l[-3,:,:] # last timeslot uses the one but last
+    #    data_shifted_r[0,:,:] = data_shifted_r[2,:,:] # first timeslot uses third
+    ## get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
+    #ratio_l = np.nanvar(data_shifted_l, axis=(1,2))/np.nanmean(data_shifted_l, axis=(1,2))
+    #ratio_l[ np.isnan(ratio_l) ] = np.inf
+    #ratio_r = np.nanvar(data_shifted_r, axis=(1,2))/np.nanmean(data_shifted_r, axis=(1,2))
+    #ratio_r[ np.isnan(ratio_r) ] = np.inf
+    #print 'subtime'
+    #print ( ratio_l < ratio_r )[np.newaxis,:,np.newaxis]
+    #print 'subtime'
+    #print w - data_shifted_l
+    #w = np.where( ( ratio_l < ratio_r )[:,np.newaxis,np.newaxis], w - data_shifted_l, w - data_shifted_r)
+    ####
+
+    ### TEST           
+    #med_freqs = np.abs( np.nanmean( w, axis=(1) )**2 ) # time x pol
+    #med_times = np.abs( np.nanmean( w, axis=(0) )**2 ) # freq x pol
+    #med_antenna = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
+    #var_freqs = np.nanvar( w, axis=(1) ) # time x pol
+    #var_times = np.nanvar( w, axis=(0) ) # freq x pol
+    #var_antenna = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
+    #var_antenna = 1/(var_antenna*med_antenna)
+    ###
+
+
+
+    w_f = np.nanmedian(w, axis=0) # average in time
+    w_t = np.nanmedian(w, axis=1) # average in freq
+
+    # 3D plot
+    bbox = ax1.get_window_extent().transformed(fig.dpi_scale_trans.inverted())
+    aspect = (time[-1]-time[0])*bbox.height/((freqs[-1]-freqs[0])*bbox.width)
+
+    im = ax1.imshow(w[...,0].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+                    extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    im = ax2.imshow(w[...,1].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+                    extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    im = ax3.imshow(w[...,2].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+                    extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    im = ax4.imshow(w[...,3].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+                    extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+
+    ### TEST
+    #im = ax1.imshow(var_antenna[...,0].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+    #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    #im = ax2.imshow(var_antenna[...,1].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+    #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    #im = ax3.imshow(var_antenna[...,2].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+    #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    #im = ax4.imshow(var_antenna[...,3].T, origin='lower', interpolation="none", cmap=plt.cm.jet, \
+    #                extent=[time[0],time[-1],freqs[0],freqs[-1]], aspect=str(aspect))#, vmin=1e5, vmax=1e6)
+    ###
+
+    ax2.tick_params(labelleft=False)
+    ax4.tick_params(labelleft=False)
+    ax3.set_xlabel('Time [h]')
+    ax4.set_xlabel('Time [h]')
+    ax1.set_ylabel('Frequency [MHz]')
+    ax3.set_ylabel('Frequency [MHz]')
+
+    # Elevation
+    ax_elev = axt.twinx()
+    ax_elev.plot(time, elev * 180/np.pi, 'k', linestyle=':', linewidth=1, label='Elevation')
+    ax_elev.set_ylabel('Elevation [deg]')
+
+    axt.scatter(time, w_t[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
+    axt.scatter(time, w_t[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
+    axt.scatter(time, w_t[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
+    axt.scatter(time, w_t[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
+    axt.set_xlim(np.min(time), np.max(time))
+    axt.set_ylim(np.nanmin(w_t), np.nanmax(w_t))
+    axt.set_xlabel('Time [h]')
+
+    axf.scatter(freqs, w_f[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
+    axf.scatter(freqs, w_f[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
+    axf.scatter(freqs, w_f[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
+    axf.scatter(freqs, w_f[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
+    axf.set_xlim(np.min(freqs), np.max(freqs))
+    axf.set_ylim(np.nanmin(w_f), np.nanmax(w_f))
+    axf.set_xlabel('Frequency [MHz]')
+
+    handles, labels = axt.get_legend_handles_labels()
+    handles2, labels2 = ax_elev.get_legend_handles_labels()
+    leg = axt.legend(handles+handles2, labels+labels2, loc='upper center', bbox_to_anchor=(0.5, 1.2), ncol=5, borderaxespad=0.0)
+
+    ###
+    # TEST on residuals
+    #med_freqs = np.abs( np.nanmean( w, axis=(1,2) )**2 ) # time x pol
+    #med_times = np.abs( np.nanmean( w, axis=(0,1) )**2 ) # freq x pol
+    #med_antenna[ant_id] = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
+
+    #var_freqs = np.nanvar( w, axis=(1,2) ) # time x pol
+    #var_times = np.nanvar( w, axis=(0,1) ) # freq x pol
+    #var_antenna[ant_id] = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
+
+    #w_f = np.nanvar(w, axis=0) # variance in time
+    #w_t = np.nanvar(w, axis=1) # variance in freq
+    #axtv.scatter(time, w_t[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
+    #axtv.scatter(time, w_t[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
+    #axtv.scatter(time, w_t[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
+    #axtv.scatter(time, w_t[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
+    #axtv.set_xlim(np.min(time), np.max(time))
+    #axtv.set_ylim(np.nanmin(w_t), np.nanmax(w_t))
+    #axtv.set_xlabel('Time [h]')
+    #axtv.set_yscale("log")
+
+    #axfv.scatter(freqs, w_f[:,0], marker='.', alpha=0.25, color='red', label='XX Weights')
+    #axfv.scatter(freqs, w_f[:,1], marker='.', alpha=0.25, color='green', label='XY Weights')
+    #axfv.scatter(freqs, w_f[:,2], marker='.', alpha=0.25, color='orange', label='YX Weights')
+    #axfv.scatter(freqs, w_f[:,3], marker='.', alpha=0.25, color='blue', label='YY Weights')
+    #axfv.set_xlim(np.min(freqs), np.max(freqs))
+    #axfv.set_ylim(np.nanmin(w_f), np.nanmax(w_f))
+    #axfv.set_xlabel('Frequency [MHz]')
+    #axfv.set_yscale("log")
+    ####
+
+    imagename = ant_name+'.png'
+    logging.info('Save file: %s' % (imagename))
+    fig.savefig(imagename, bbox_inches='tight', bbox_extra_artists=[leg], dpi=250)
+    plt.close(fig)
 
 def readArguments():
     import argparse
@@ -380,6 +902,9 @@ def readArguments():
     parser.add_argument("-m", "--mode", type=str, help="Mode can be: 'residual' if dcolname contain residual data; 'subchan'/'subtime' if adjacent-channel or adjacent-time subtraction has to be performed to remove the signal in dcolname. If not given do not update weights. Default: do not update", required=False, default=None)
     parser.add_argument("-d", "--dcolname", type=str, help="Name of the data column. Default: DATA.", required=False, default='DATA')
     parser.add_argument("-w", "--wcolname", type=str, help="Name of the weights column. Default: WEIGHT_SPECTRUM.", required=False, default="WEIGHT_SPECTRUM")
+    parser.add_argument("-n", "--ncpu", type=int, help="Number of MSs read/written (or antennas plotted) in parallel by worker processes, the statistics of the MSs are merged. Default: 1.", required=False, default=1)
+    parser.add_argument("-c", "--chunk", type=int, help="Number of rows processed at once, it limits the memory usage. Default: 100000.", required=False, default=100000)
+    parser.add_argument("--nocache", help="Do not use/save the antenna statistics in <first MS>/reweight_stats_<dcolname>.npz, used to apply the same weights again without reading the data (a rerun without cache recomputes them excluding the new flags) or to plot them reading only FLAG. Default is False", required=False, action="store_true")
     parser.add_argument("-a", "--antennas", type=str, help="List of antennas to plot (comma separated). Default: all antennas", required=False, default=None)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
     args=parser.parse_args()
@@ -399,10 +924,6 @@ if __name__=="__main__":
     if verbose: logging.basicConfig(level=logging.DEBUG)
     else: logging.basicConfig(level=logging.INFO)
 
-    if len(ms_files) > 1:
-        logging.error('More than 1 MS not implemented.')
-        sys.exit()
-
     if args["antennas"] is not None:
         antennas = args["antennas"].replace(' ','').split(',')
     else: antennas = None
@@ -413,15 +934,18 @@ if __name__=="__main__":
     elif mode is not None:
         logging.info('Mode: %s' % mode)
 
-    logging.info('Reading MSs...')
-    MSh = MShandler(ms_files, wcolname, dcolname)
+    # the same worker processes read/write the MSs and plot, they are forked before any table is opened
+    # (they would share its file handles)
+    with multiprocPool(args["ncpu"]) if args["ncpu"] > 1 else contextlib.nullcontext() as pool:
+        logging.info('Reading MSs...')
+        MSh = MShandler(ms_files, wcolname, dcolname)
 
-    if mode is not None:
-        logging.info('Computing weights...')
-        reweight(MSh, mode)
+        if mode is not None:
+            logging.info('Computing weights...')
+            reweight(MSh, mode, args["chunk"], pool, not args["nocache"])
 
-    if do_plot:
-        logging.info('Plotting...')
-        plot(MSh, antennas)
+        if do_plot:
+            logging.info('Plotting...')
+            plot(MSh, antennas, not args["nocache"], pool)
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
@@ -22,6 +22,7 @@ import numpy as np
 from lib_linearfit import linear_fit_bootstrap
 from lib_fits import flatten
 from lib_beamdeconv import findCommonBeam
+from lib_timer import profile_script
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.coordinates import match_coordinates_sky
@@ -47,6 +48,7 @@ parser.add_argument('--circbeam', dest='circbeam', action='store_true', help='Fo
 parser.add_argument('--output', dest='output', default='spidx.fits', help='Name of output mosaic (default: spidx.fits)')
 
 args = parser.parse_args()
+profile_script(os.path.dirname(os.path.abspath(args.output))) # with $SCRIPTS_PROFILE
 
 # check input
 if len(args.images) < 2: